@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+"""
+Append-only archive of fetched schedules and status transitions.
+
+    python archive.py outages --by month
+    python archive.py changes --within 2
+"""
+import logging
+
+logger = logging.getLogger("esp_mqtt").getChild(__name__)
+import argparse
+import mmap
+import os
+import re
+import struct
+from bisect import bisect
+from datetime import datetime, timedelta, time
+
+from config_defaults import *
+from config import *
+from pytz import timezone
+
+# kind, stage or state, area string id, note string id (event count for a
+# SNAPSHOT), time (0 for an EVENT), start, end.  Times are epoch seconds.
+RECORD = struct.Struct("<BBHIddd")
+HEADER = b"ESPARCH1".ljust(RECORD.size, b"\0")
+
+SNAPSHOT = 1  # a fetched schedule, followed by its EVENT records
+EVENT = 2
+TRANSITION = 3  # stage is 1 when loadshedding started, 0 when it ended
+
+STAGE = re.compile(r"Stage (\d+)")
+
+
+def stage_of(note):
+    match = STAGE.search(note or "")
+    if match == None:
+        return 0
+    return min(int(match.group(1)), 255)
+
+
+def read_strings(directory):
+    path = os.path.join(directory, "strings.txt")
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        return f.read().split("\n")[:-1]
+
+
+def segment_paths(directory):
+    return sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.startswith("segment-") and name.endswith(".bin")
+    )
+
+
+def map_segment(path):
+    """Read only memory map of a segment and its number of whole records."""
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= len(HEADER):
+            return None, 0
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if m[: len(HEADER)] != HEADER:
+        logger.error("{} is not an archive segment.".format(path))
+        m.close()
+        return None, 0
+    # a crash may leave part of a record at the end
+    return m, (size - len(HEADER)) // RECORD.size
+
+
+class Archive:
+    def __init__(self, directory, segment_bytes=ESP_ARCHIVE_SEGMENT_BYTES):
+        """
+        Writes 32 byte records to segment files in directory, starting a new
+        segment once one reaches segment_bytes.  Area ids and notes are kept
+        once in strings.txt and referred to by line number.  A schedule is
+        only written when it differs from the last one written for the area.
+        """
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.repair()
+        self.strings = read_strings(directory)
+        self.string_ids = dict((s, i) for i, s in enumerate(self.strings))
+        paths = segment_paths(directory)
+        self.segment = paths[-1] if paths else self.segment_path(1)
+        # area_id -> events last written
+        self.schedules = {}
+
+    def repair(self):
+        """Drop what a crash left half written, so appends stay aligned."""
+        path = os.path.join(self.directory, "strings.txt")
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                data = f.read()
+            if not data.endswith(b"\n"):
+                os.truncate(path, data.rfind(b"\n") + 1)
+        paths = segment_paths(self.directory)
+        if paths:
+            size = os.path.getsize(paths[-1])
+            if size < len(HEADER):
+                os.truncate(paths[-1], 0)
+            elif (size - len(HEADER)) % RECORD.size:
+                os.truncate(paths[-1], size - (size - len(HEADER)) % RECORD.size)
+
+    def segment_path(self, number):
+        return os.path.join(self.directory, "segment-{:06d}.bin".format(number))
+
+    def string_id(self, s):
+        s = (s or "").replace("\n", " ")
+        if s not in self.string_ids:
+            with open(
+                os.path.join(self.directory, "strings.txt"), "a", encoding="utf-8"
+            ) as f:
+                f.write(s + "\n")
+            self.string_ids[s] = len(self.strings)
+            self.strings.append(s)
+        return self.string_ids[s]
+
+    def append(self, records):
+        data = b"".join(RECORD.pack(*r) for r in records)
+        try:
+            if (
+                os.path.exists(self.segment)
+                and os.path.getsize(self.segment) >= self.segment_bytes
+            ):
+                number = int(os.path.basename(self.segment)[8:14]) + 1
+                self.segment = self.segment_path(number)
+            with open(self.segment, "ab") as f:
+                if f.tell() == 0:
+                    f.write(HEADER)
+                f.write(data)
+        except OSError as e:
+            logger.error("Could not archive to {}: {}".format(self.segment, e))
+
+    def schedule(self, area_id, when, events):
+        """Archive the events fetched for area_id at when (epoch seconds)."""
+        key = [(e.start, e.end, e.note) for e in events]
+        if self.schedules.get(area_id) == key:
+            return
+        self.schedules[area_id] = key
+        area = self.string_id(area_id)
+        records = [(SNAPSHOT, 0, area, len(events), when, 0, 0)]
+        for e in events:
+            records.append(
+                (
+                    EVENT,
+                    stage_of(e.note),
+                    area,
+                    self.string_id(e.note),
+                    0,
+                    e.start,
+                    e.end,
+                )
+            )
+        self.append(records)
+
+    def transition(self, area_id, when, loadshedding, note):
+        """Archive a status change of area_id at when (epoch seconds)."""
+        self.append(
+            [
+                (
+                    TRANSITION,
+                    int(loadshedding),
+                    self.string_id(area_id),
+                    self.string_id(note),
+                    when,
+                    0,
+                    0,
+                )
+            ]
+        )
+
+
+def periods(first, last, by):
+    """
+    Epoch seconds each local day or month from first to past last starts
+    at, and its name.
+    """
+    tz = timezone(TIMEZONE)
+    d = datetime.fromtimestamp(first, tz).date()
+    if by == "month":
+        d = d.replace(day=1)
+    starts = []
+    names = []
+    while not starts or starts[-1] <= last:
+        starts.append(tz.localize(datetime.combine(d, time.min)).timestamp())
+        names.append(d.strftime("%Y-%m" if by == "month" else "%Y-%m-%d"))
+        if by == "month":
+            d = (d.replace(day=28) + timedelta(days=4)).replace(day=1)
+        else:
+            d += timedelta(days=1)
+    return starts, names
+
+
+class History:
+    def __init__(self, directory=ESP_ARCHIVE_DIR):
+        """
+        Queries over everything in the archive.  The segments stay memory
+        mapped and only the kind of each record, one byte every RECORD.size,
+        is copied out to find the records a query wants.
+        """
+        self.strings = read_strings(directory)
+        # (map, kinds) of each segment
+        self.segments = []
+        for path in segment_paths(directory):
+            m, count = map_segment(path)
+            if m != None:
+                end = len(HEADER) + count * RECORD.size
+                self.segments.append((m, m[len(HEADER) : end : RECORD.size]))
+
+    def __len__(self):
+        return sum(len(kinds) for _, kinds in self.segments)
+
+    def close(self):
+        for m, _ in self.segments:
+            m.close()
+        self.segments = []
+
+    def find(self, kind, area_id=None):
+        """Map, offset and fields of each record of kind, of area_id if given."""
+        area = None
+        if area_id != None:
+            if area_id not in self.strings:
+                return
+            area = self.strings.index(area_id)
+        k = bytes([kind])
+        for m, kinds in self.segments:
+            i = kinds.find(k)
+            while i != -1:
+                offset = len(HEADER) + i * RECORD.size
+                record = RECORD.unpack_from(m, offset)
+                if area == None or record[2] == area:
+                    yield m, offset, record
+                i = kinds.find(k, i + 1)
+
+    def outages(self, area_id=None, until=None):
+        """
+        (area_id, start, end) of each outage seen in epoch seconds, one that
+        is still on ends at until (now).
+        """
+        if until == None:
+            until = datetime.now().timestamp()
+        started = {}
+        outages = []
+        for _, _, r in self.find(TRANSITION, area_id):
+            if r[1]:
+                started.setdefault(r[2], r[4])
+            elif r[2] in started:
+                outages.append((self.strings[r[2]], started.pop(r[2]), r[4]))
+        for area, start in started.items():
+            outages.append((self.strings[area], start, until))
+        return outages
+
+    def outage_hours(self, by="day", area_id=None, until=None):
+        """Hours of loadshedding by (area_id, day or month), split at midnight."""
+        outages = self.outages(area_id, until)
+        if not outages:
+            return {}
+        starts, names = periods(
+            min(o[1] for o in outages), max(o[2] for o in outages), by
+        )
+        hours = {}
+        for area, start, end in outages:
+            i = bisect(starts, start) - 1
+            while start < end:
+                boundary = min(starts[i + 1], end)
+                key = (area, names[i])
+                hours[key] = hours.get(key, 0) + (boundary - start) / 3600
+                start = boundary
+                i += 1
+        return hours
+
+    def schedule_changes(self, within=2, area_id=None):
+        """
+        By (area_id, month) the number of fetched schedules that changed an
+        event starting within the given hours of the fetch, and the number
+        of changes.
+        """
+        snapshots = list(self.find(SNAPSHOT, area_id))
+        if not snapshots:
+            return {}
+        starts, names = periods(snapshots[0][2][4], snapshots[-1][2][4], "month")
+        last = {}
+        changes = {}
+        for m, offset, (_, _, area, count, when, _, _) in snapshots:
+            # EVENT records carry no time so equal schedules are equal bytes
+            offset += RECORD.size
+            events = m[offset : offset + count * RECORD.size]
+            before = last.get(area)
+            last[area] = events
+            if before == None or before == events:
+                continue
+            key = (self.strings[area], names[bisect(starts, when) - 1])
+            counts = changes.setdefault(key, [0, 0])
+            counts[1] += 1
+            soon = when + within * 3600
+            if spans(before, when, soon) != spans(events, when, soon):
+                counts[0] += 1
+        return changes
+
+
+def spans(events, first, last):
+    """(note, start, end) of the packed EVENT records starting first to last."""
+    return set(
+        (r[3], r[5], r[6]) for r in RECORD.iter_unpack(events) if first <= r[5] <= last
+    )
+
+
+if __name__ == "__main__":
+    from time import perf_counter
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("query", choices=["outages", "changes"])
+    parser.add_argument("--dir", default=ESP_ARCHIVE_DIR, help="archive directory")
+    parser.add_argument("--area", help="only this area id")
+    parser.add_argument("--by", choices=["day", "month"], default="day")
+    parser.add_argument(
+        "--within", type=float, default=2, help="hours before an event start"
+    )
+    args = parser.parse_args()
+    if args.dir == None:
+        parser.error("set ESP_ARCHIVE_DIR or pass --dir")
+
+    started = perf_counter()
+    history = History(args.dir)
+    loaded = perf_counter()
+    if args.query == "outages":
+        result = history.outage_hours(args.by, args.area)
+        for (area, period), hours in sorted(result.items()):
+            print("{}\t{}\t{:.2f}".format(area, period, hours))
+    else:
+        result = history.schedule_changes(args.within, args.area)
+        print("area\tmonth\tlate\tchanges")
+        for (area, month), (late, total) in sorted(result.items()):
+            print("{}\t{}\t{}\t{}".format(area, month, late, total))
+    logger.info(
+        "{} records read in {:.1f}ms, queried in {:.1f}ms.".format(
+            len(history),
+            (loaded - started) * 1e3,
+            (perf_counter() - loaded) * 1e3,
+        )
+    )
+    history.close()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+"""
+Local stand-in for the EskomSePush business API.
+
+Serves `area`, `status` and `api_allowance` with generated schedules,
+optional latency and a configurable share of server errors.  `area` and
+`status` calls count against the allowance like the real API.
+"""
+import json
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from pytz import timezone
+
+TIMEZONE = "Africa/Johannesburg"
+PREFIX = "/business/2.0/"
+
+
+def slot_string(start_hour, minutes=150):
+    start = datetime(2000, 1, 1, start_hour)
+    end = start + timedelta(minutes=minutes)
+    return "{}-{}".format(start.strftime("%H:%M"), end.strftime("%H:%M"))
+
+
+def random_schedule(area_id, start_date, days=7):
+    """A stage 1-8 timetable that is stable per area."""
+    rng = random.Random(area_id)
+    offset = rng.randrange(0, 4) * 2
+    result = []
+    for day in range(days):
+        d = start_date + timedelta(days=day)
+        stages = []
+        hours = []
+        for stage in range(8):
+            hours.append((offset + stage * 6 + day * 2) % 24)
+            stages.append([slot_string(h) for h in sorted(set(hours))])
+        result.append(
+            {"date": d.isoformat(), "name": d.strftime("%A"), "stages": stages}
+        )
+    return {"days": result, "source": "fake"}
+
+
+class FakeESPAPI:
+    def __init__(
+        self,
+        stage=2,
+        latency=0,
+        error_rate=0,
+        limit=50,
+        now=None,
+        seed=0,
+        host="127.0.0.1",
+        port=0,
+    ):
+        self.stage = stage
+        self.latency = latency
+        self.error_rate = error_rate
+        self.limit = limit
+        self.count = 0
+        self.requests = []
+        self.events = {}
+        self.now = now or (lambda: datetime.now(timezone(TIMEZONE)))
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                api.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.url = "http://{}:{}{}".format(host, self.server.server_port, PREFIX)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def set_events(self, area_id, events):
+        """Canned events for an area: list of (start, end, note)."""
+        self.events[area_id] = events
+
+    def area(self, area_id, query):
+        now = self.now()
+        schedule = random_schedule(area_id, now.date())
+        if area_id in self.events:
+            events = self.events[area_id]
+        else:
+            events = []
+            tz = timezone(TIMEZONE)
+            for day in schedule["days"]:
+                if self.stage < 1:
+                    break
+                d = datetime.fromisoformat(day["date"]).date()
+                for slot in day["stages"][self.stage - 1]:
+                    start, end = slot.split("-")
+                    start = tz.localize(
+                        datetime.combine(d, datetime.strptime(start, "%H:%M").time())
+                    )
+                    end = tz.localize(
+                        datetime.combine(d, datetime.strptime(end, "%H:%M").time())
+                    )
+                    if end <= start:
+                        end += timedelta(days=1)
+                    events.append((start, end, "Stage {}".format(self.stage)))
+        return {
+            "events": [
+                {"start": s.isoformat(), "end": e.isoformat(), "note": n}
+                for s, e, n in events
+            ],
+            "info": {"name": area_id.title(), "region": "Fake Region"},
+            "schedule": schedule,
+        }
+
+    def status(self):
+        region = {"name": "", "next_stages": [], "stage": str(self.stage)}
+        region["stage_updated"] = self.now().isoformat()
+        return {"status": {"capetown": dict(region), "eskom": dict(region)}}
+
+    def handle(self, request):
+        url = urlparse(request.path)
+        endpoint = url.path[len(PREFIX) :]
+        query = parse_qs(url.query)
+        with self.lock:
+            self.requests.append((time.time(), endpoint))
+        if self.latency:
+            time.sleep(self.latency)
+        if request.headers.get("token") == None:
+            return self.reply(request, 403, {"error": "no token"})
+        if self.error_rate and self.random.random() < self.error_rate:
+            return self.reply(request, 500, {"error": "fake failure"})
+        if endpoint == "api_allowance":
+            body = {
+                "allowance": {"count": self.count, "limit": self.limit, "type": "daily"}
+            }
+        elif endpoint == "area":
+            with self.lock:
+                self.count += 1
+            body = self.area(query["id"][0], query)
+        elif endpoint == "status":
+            with self.lock:
+                self.count += 1
+            body = self.status()
+        else:
+            return self.reply(request, 404, {"error": "unknown endpoint"})
+        self.reply(request, 200, body)
+
+    def reply(self, request, code, body):
+        data = json.dumps(body).encode("utf-8")
+        request.send_response(code)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+"""
+Minimal in-process MQTT 3.1.1 broker for benchmarks.
+
+Enough of the protocol for paho: CONNECT with will, PUBLISH at QoS 0, 1
+and 2, SUBSCRIBE (delivered at QoS 0), UNSUBSCRIBE, PINGREQ and
+DISCONNECT.  Every publish received is recorded with the time it
+arrived.
+"""
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+CONNECT = 1
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+UNSUBSCRIBE = 10
+PINGREQ = 12
+DISCONNECT = 14
+
+
+def topic_matches(topic_filter, topic):
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for i, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if i >= len(topic_levels):
+            return False
+        if level != "+" and level != topic_levels[i]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+def encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length > 0:
+            byte |= 0x80
+        encoded.append(byte)
+        if length == 0:
+            return bytes(encoded)
+
+
+def encode_string(s):
+    s = s.encode("utf-8")
+    return struct.pack("!H", len(s)) + s
+
+
+def publish_packet(topic, payload, retain=False):
+    body = encode_string(topic) + payload
+    return bytes([(PUBLISH << 4) | int(retain)]) + encode_length(len(body)) + body
+
+
+class Message:
+    def __init__(self, client_id, topic, payload, qos, retain):
+        self.time = time.time()
+        self.client_id = client_id
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+
+
+class Handler(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.broker = self.server.broker
+        # like real brokers, do not hold back small acks
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.client_id = None
+        self.will = None
+        self.subscriptions = set()
+        self.lock = threading.Lock()
+
+    def send(self, data):
+        with self.lock:
+            self.request.sendall(data)
+
+    def read(self, n):
+        data = b""
+        while len(data) < n:
+            chunk = self.request.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError("closed")
+            data += chunk
+        return data
+
+    def read_packet(self):
+        header = self.read(1)[0]
+        length = 0
+        multiplier = 1
+        while True:
+            byte = self.read(1)[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return header >> 4, header & 0x0F, self.read(length)
+
+    def handle(self):
+        clean = False
+        try:
+            while True:
+                packet_type, flags, body = self.read_packet()
+                if packet_type == CONNECT:
+                    self.connect(body)
+                elif packet_type == PUBLISH:
+                    self.publish(flags, body)
+                elif packet_type == PUBREL:
+                    self.send(bytes([PUBCOMP << 4, 2]) + body[:2])
+                elif packet_type == SUBSCRIBE:
+                    self.subscribe(body)
+                elif packet_type == UNSUBSCRIBE:
+                    self.unsubscribe(body)
+                elif packet_type == PINGREQ:
+                    self.send(bytes([0xD0, 0]))
+                elif packet_type == DISCONNECT:
+                    clean = True
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.broker.disconnected(self, clean)
+
+    def connect(self, body):
+        i = 2 + struct.unpack("!H", body[:2])[0]
+        flags = body[i + 1]
+        i += 4
+        self.client_id, i = self.string(body, i)
+        if flags & 0x04:
+            topic, i = self.string(body, i)
+            length = struct.unpack("!H", body[i : i + 2])[0]
+            payload = body[i + 2 : i + 2 + length]
+            self.will = (topic, payload, (flags >> 3) & 0x03, bool(flags & 0x20))
+        self.broker.connected(self)
+        self.send(bytes([0x20, 2, 0, 0]))
+
+    def string(self, body, i):
+        length = struct.unpack("!H", body[i : i + 2])[0]
+        return body[i + 2 : i + 2 + length].decode("utf-8"), i + 2 + length
+
+    def publish(self, flags, body):
+        qos = (flags >> 1) & 0x03
+        retain = bool(flags & 0x01)
+        topic, i = self.string(body, 0)
+        if qos > 0:
+            packet_id = body[i : i + 2]
+            i += 2
+        self.broker.received(self.client_id, topic, body[i:], qos, retain)
+        if qos == 1:
+            self.send(bytes([PUBACK << 4, 2]) + packet_id)
+        elif qos == 2:
+            self.send(bytes([PUBREC << 4, 2]) + packet_id)
+
+    def subscribe(self, body):
+        packet_id = body[:2]
+        i = 2
+        filters = []
+        while i < len(body):
+            topic_filter, i = self.string(body, i)
+            i += 1
+            filters.append(topic_filter)
+        self.subscriptions.update(filters)
+        granted = bytes(len(filters))
+        self.send(bytes([0x90]) + encode_length(2 + len(granted)) + packet_id + granted)
+        for topic, payload in self.broker.retained_matching(filters):
+            self.send(publish_packet(topic, payload, retain=True))
+
+    def unsubscribe(self, body):
+        i = 2
+        while i < len(body):
+            topic_filter, i = self.string(body, i)
+            self.subscriptions.discard(topic_filter)
+        self.send(bytes([0xB0, 2]) + body[:2])
+
+
+class Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeBroker:
+    def __init__(self, host="127.0.0.1", port=0):
+        self.server = Server((host, port), Handler)
+        self.server.broker = self
+        self.host, self.port = self.server.server_address
+        self.messages = []
+        self.retained = {}
+        self.clients = set()
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def connected(self, client):
+        with self.condition:
+            self.clients.add(client)
+
+    def disconnected(self, client, clean):
+        with self.condition:
+            self.clients.discard(client)
+        if not clean and client.will != None:
+            topic, payload, qos, retain = client.will
+            self.received(client.client_id, topic, payload, qos, retain)
+
+    def received(self, client_id, topic, payload, qos, retain):
+        message = Message(client_id, topic, payload, qos, retain)
+        with self.condition:
+            self.messages.append(message)
+            if retain:
+                if payload:
+                    self.retained[topic] = payload
+                else:
+                    self.retained.pop(topic, None)
+            clients = list(self.clients)
+            self.condition.notify_all()
+        packet = publish_packet(topic, payload)
+        for client in clients:
+            if any(topic_matches(f, topic) for f in client.subscriptions):
+                try:
+                    client.send(packet)
+                except OSError:
+                    pass
+
+    def retained_matching(self, filters):
+        with self.condition:
+            return [
+                (topic, payload)
+                for topic, payload in self.retained.items()
+                if any(topic_matches(f, topic) for f in filters)
+            ]
+
+    def publish(self, topic, payload, retain=False):
+        """Publish from the broker itself, for example a /set command."""
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        self.received("broker", topic, payload, 0, retain)
+
+    def wait_for(self, predicate, timeout=10, since=0):
+        """Wait for the first message from index since matching predicate."""
+        deadline = time.monotonic() + timeout
+        checked = since
+        with self.condition:
+            while True:
+                for message in self.messages[checked:]:
+                    if predicate(message):
+                        return message
+                checked = len(self.messages)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+    def wait_for_count(self, count, timeout=10):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while len(self.messages) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
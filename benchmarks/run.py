@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+"""
+Offline benchmarks for esp_mqtt.
+
+Runs the service against a local fake ESP API and an in-process MQTT
+broker, so no network or API quota is used:
+
+    python benchmarks/run.py --areas 10
+
+Reports homie_init, homie_publish_all and update_loadshedding_status
+throughput, end to end transition latency (event start to MQTT message),
+messages per hour over a simulated day, cold start to the first status
+and memory use.
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+import types
+from datetime import timedelta
+from functools import partial
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from clock import VirtualClock
+from fake_api import FakeESPAPI, TIMEZONE
+from fake_broker import FakeBroker
+from pytz import timezone
+
+
+def configure(api, brokers, args):
+    """Install a config module pointing the service at the fakes."""
+    config = types.ModuleType("config")
+    config.ESP_API_TOKEN = "benchmark"
+    config.ESP_API_URL = api.url
+    config.MQTT_HOST = brokers[0].host
+    config.MQTT_PORT = brokers[0].port
+    if len(brokers) > 1:
+        config.MQTT_BROKERS = [
+            {"name": "fake{}".format(i), "host": b.host, "port": b.port}
+            for i, b in enumerate(brokers)
+        ]
+    config.ESP_AREAS = ["benchmark-{}-area".format(i) for i in range(args.areas)]
+    config.ESP_API_RETRIES = 0
+    sys.modules["config"] = config
+
+
+def rss_kb():
+    with open("/proc/self/statm") as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE") // 1024
+
+
+def timed(function, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        function()
+    return (time.perf_counter() - start) / rounds
+
+
+def make_esp(esp, clock=None):
+    e = esp.ESP(clock=clock)
+    deadline = time.monotonic() + 10
+    while not all(b.is_connected() for b in e.brokers):
+        if time.monotonic() > deadline:
+            break
+        time.sleep(0.01)
+    return e
+
+
+def drain(e, timeout=10):
+    """Hand acknowledgements to the publishers until they are idle."""
+    deadline = time.monotonic() + timeout
+    for publisher in [b.publisher for b in e.brokers]:
+        while publisher.queued() or publisher.inflight:
+            if time.monotonic() > deadline:
+                return False
+            with e.scheduler.condition:
+                # call_soon from the network thread notifies
+                if not publisher.acks:
+                    e.scheduler.condition.wait(0.01)
+            for b in e.brokers:
+                b.publisher.acknowledged()
+    return True
+
+
+def synchronous_fetches(e):
+    """Run fetches inline so virtual time does not race the fetch thread."""
+    e.fetcher.submit = lambda work, callback: e.scheduler.call_soon(
+        partial(callback, work())
+    )
+
+
+def bench_status(e, rounds):
+    area = e.areas[0]
+    area.load_area(area.fetch_area())
+    per_call = timed(area.update_loadshedding_status, rounds)
+    return {"events": len(area.events), "us_per_call": per_call * 1e6}
+
+
+def bench_init(e, broker, rounds):
+    results = []
+    for _ in range(rounds):
+        before = len(broker.messages)
+        start = time.perf_counter()
+        e.homie_init()
+        called = time.perf_counter()
+        expected = before + sum(len(a.device.init_messages) + 1 for a in e.areas)
+        drain(e)
+        broker.wait_for_count(expected)
+        received = time.perf_counter()
+        results.append((called - start, received - start, expected - before))
+    messages = results[0][2]
+    call = sum(r[0] for r in results) / rounds
+    total = sum(r[1] for r in results) / rounds
+    return {
+        "messages": messages,
+        "call_ms": call * 1e3,
+        "delivered_ms": total * 1e3,
+        "messages_per_second": messages / total,
+    }
+
+
+def count_publishes(e):
+    """Record the topics handed to the first broker."""
+    published = []
+    broker = e.brokers[0]
+    publish = broker.publish
+
+    def counted(topic, message):
+        published.append(topic)
+        publish(topic, message)
+
+    broker.publish = counted
+    return published
+
+
+def bench_publish_all(e, rounds):
+    for area in e.areas:
+        area.update_loadshedding_status()
+    published = count_publishes(e)
+    e.homie_publish_all()
+    drain(e)
+    del published[:]
+    cached = timed(e.homie_publish_all, rounds)
+    cached_messages = len(published) / rounds
+
+    def forced():
+        e.brokers[0].published = {}
+        e.homie_publish_all()
+
+    del published[:]
+    forced_time = timed(forced, rounds)
+    drain(e)
+    return {
+        "unchanged_us": cached * 1e6,
+        "unchanged_messages": cached_messages,
+        "forced_us": forced_time * 1e6,
+        "forced_messages": len(published) / rounds,
+    }
+
+
+def bench_virtual_day(esp, api, hours):
+    tz = timezone(TIMEZONE)
+    clock = VirtualClock(api.now())
+    real_now = api.now
+    api.now = lambda: clock.now(tz)
+    api.count = 0
+    try:
+        e = make_esp(esp, clock)
+        synchronous_fetches(e)
+        published = count_publishes(e)
+        e.start()
+        end = clock.monotonic() + hours * 3600
+        while True:
+            deadline = e.scheduler.next_deadline()
+            if deadline == None or deadline > end:
+                break
+            clock.advance_to(deadline)
+            e.scheduler.run_pending()
+        e.brokers[0].disconnect()
+    finally:
+        api.now = real_now
+    return {
+        "hours": hours,
+        "messages_per_hour": len(published) / hours,
+        "api_calls": api.count,
+    }
+
+
+def bench_transition(esp, api, broker, lead):
+    start = api.now() + timedelta(seconds=lead)
+    end = start + timedelta(minutes=30)
+    for area_id in sys.modules["config"].ESP_AREAS:
+        api.set_events(area_id, [(start, end, "Stage 9")])
+    api.count = 0
+    since = len(broker.messages)
+    e = make_esp(esp)
+    threading.Thread(target=e.main_loop, daemon=True).start()
+    topic = e.areas[0].device.properties["status", "loadshedding"][0]
+    message = broker.wait_for(
+        lambda m: m.topic == topic and m.payload == b"true",
+        timeout=lead + 10,
+        since=since,
+    )
+    e.brokers[0].disconnect()
+    if message == None:
+        return {"latency_ms": None}
+    return {"latency_ms": (message.time - start.timestamp()) * 1e3}
+
+
+def bench_cold_start(esp, api, broker, state_file):
+    """Seconds from start to the first status on the broker, without and with state."""
+    results = {}
+    for run in ["cold", "cached"]:
+        since = len(broker.messages)
+        start = time.time()
+        e = esp.ESP(state_file=state_file)
+        threading.Thread(target=e.main_loop, daemon=True).start()
+        topic = e.areas[0].device.properties["status", "loadshedding"][0]
+        message = broker.wait_for(lambda m: m.topic == topic, since=since)
+        results[run + "_ms"] = None if message == None else (message.time - start) * 1e3
+        # the next run starts from the state this one saved
+        deadline = time.monotonic() + 10
+        while not os.path.exists(state_file) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        e.brokers[0].disconnect()
+    os.remove(state_file)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--areas", type=int, default=1)
+    parser.add_argument("--brokers", type=int, default=1)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--hours", type=float, default=24)
+    parser.add_argument("--latency", type=float, default=0, help="API latency (s)")
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--lead", type=float, default=3, help="seconds to event")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    api = FakeESPAPI(latency=args.latency, error_rate=args.error_rate).start()
+    brokers = [FakeBroker().start() for _ in range(args.brokers)]
+    broker = brokers[0]
+    configure(api, brokers, args)
+    rss_start = rss_kb()
+
+    import esp
+    import metrics
+
+    results = {}
+    e = make_esp(esp)
+    results["update_loadshedding_status"] = bench_status(e, args.rounds * 500)
+    results["homie_init"] = bench_init(e, broker, args.rounds)
+    results["homie_publish_all"] = bench_publish_all(e, args.rounds)
+    e.brokers[0].disconnect()
+    results["virtual_day"] = bench_virtual_day(esp, api, args.hours)
+    results["transition"] = bench_transition(esp, api, broker, args.lead)
+    results["cold_start"] = bench_cold_start(
+        esp, api, broker, os.path.join(tempfile.mkdtemp(), "esp_state.json")
+    )
+    results["metrics"] = {
+        "puback_ms": metrics.MQTT_PUBACK_SECONDS.mean() * 1e3,
+        "api_request_ms": metrics.API_REQUEST_SECONDS.mean() * 1e3,
+        "api_errors": metrics.API_ERRORS.total(),
+        "transition_jitter_ms": metrics.TRANSITION_JITTER_SECONDS.mean() * 1e3,
+    }
+    results["memory"] = {
+        "rss_start_kb": rss_start,
+        "rss_end_kb": rss_kb(),
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for name, values in results.items():
+            print(name)
+            for key, value in values.items():
+                if isinstance(value, float):
+                    value = "{:.3f}".format(value)
+                print("    {:<24} {}".format(key, value))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+import logging
+
+logger = logging.getLogger("esp_mqtt").getChild(__name__)
+from functools import partial
+import paho.mqtt.client as mqtt
+
+from config_defaults import *
+from config import *
+from publisher import Publisher
+
+
+def configured_brokers():
+    """Broker settings from MQTT_BROKERS, or the single MQTT_* broker."""
+    if MQTT_BROKERS == None:
+        return [
+            {
+                "name": "default",
+                "host": MQTT_HOST,
+                "port": MQTT_PORT,
+                "username": MQTT_USERNAME,
+                "password": MQTT_PASSWORD,
+            }
+        ]
+    brokers = []
+    names = set()
+    for settings in MQTT_BROKERS:
+        settings = dict(settings)
+        settings.setdefault(
+            "name",
+            "{}:{}".format(
+                settings.get("host", "localhost"), settings.get("port", 1883)
+            ),
+        )
+        # jobs and metric labels are per broker name
+        if settings["name"] in names:
+            raise ValueError("Duplicate MQTT_BROKERS name {}".format(settings["name"]))
+        names.add(settings["name"])
+        brokers.append(settings)
+    return brokers
+
+
+def will_topic(esp):
+    """
+    A connection only carries one will so it goes to the first device, or
+    the worker when the areas are sharded.
+    """
+    if esp.shard != None:
+        return esp.shard.state_topic
+    return esp.all_areas[0].device.state_topic
+
+
+class Broker:
+    def __init__(self, esp, settings, client=None):
+        """
+        One MQTT connection with its own publisher, will and record of what
+        it was sent.  settings are the MQTT_BROKERS keys: name, host, port,
+        username, password, client_id, keepalive, qos, retain, reconnect_min
+        and reconnect_max.
+        """
+        self.esp = esp
+        self.name = settings["name"]
+        self.host = settings.get("host", "localhost")
+        self.port = settings.get("port", 1883)
+        self.keepalive = settings.get("keepalive", MQTT_KEEPALIVE)
+        self.qos = settings.get("qos", HOMIE_MQTT_QOS)
+        self.retain = settings.get("retain", HOMIE_MQTT_RETAIN)
+
+        if client == None:
+            client = mqtt.Client(client_id=settings.get("client_id", MQTT_CLIENT_ID))
+        self.client = client
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_message = esp.homie_message
+        self.client.reconnect_delay_set(
+            settings.get("reconnect_min", MQTT_RECONNECT_MIN_SECONDS),
+            settings.get("reconnect_max", MQTT_RECONNECT_MAX_SECONDS),
+        )
+        username = settings.get("username")
+        password = settings.get("password")
+        if username != None and password != None:
+            self.client.username_pw_set(username=username, password=password)
+
+        self.client.will_set(
+            will_topic(esp),
+            payload="lost",
+            qos=self.qos,
+            retain=self.retain,
+        )
+
+        # last published message and monotonic time keyed by topic
+        self.published = {}
+
+        self.publisher = Publisher(self.client, esp.scheduler, self.name)
+        self.publisher.on_drop = self.on_publish_dropped
+
+    def connect(self):
+        """
+        Connect in the background and return straight away.  paho retries
+        with backoff until the broker answers, publishes queue meanwhile.
+        """
+        logger.info("Connecting to MQTT {}.".format(self.name))
+        self.client.connect_async(self.host, self.port, self.keepalive)
+        self.client.loop_start()
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            logger.info("Connected to MQTT {}...".format(self.name))
+            # only the set topics of our own devices
+            self.client.subscribe(
+                [(topic, 0) for topic in self.esp.commands.subscriptions()]
+            )
+            self.esp.scheduler.call_soon(self.connected)
+        else:
+            logger.info(
+                "Connection to MQTT {} failed return code of {}.".format(self.name, rc)
+            )
+
+    def connected(self):
+        # retained values may have been lost with the broker
+        self.published = {}
+        self.publisher.connected()
+        self.esp.scheduler.schedule(
+            "homie_init/{}".format(self.name), 0, partial(self.esp.homie_init, self)
+        )
+        if self.esp.shard != None:
+            if self.esp.shard.broker is self:
+                self.esp.shard.connected()
+            else:
+                # this connection's will, Home Assistant entities follow it
+                self.publish(will_topic(self.esp), "ready")
+
+    def on_disconnect(self, client, userdata, rc):
+        logger.info(
+            "MQTT {} was disconnected with return code of {}".format(self.name, rc)
+        )
+        self.esp.scheduler.call_soon(self.disconnected)
+
+    def disconnected(self):
+        self.publisher.disconnected()
+        if self.esp.shard != None and self.esp.shard.broker is self:
+            self.esp.shard.disconnected()
+
+    def is_connected(self):
+        return self.client.is_connected()
+
+    def disconnect(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def publish(self, topic, message):
+        self.publisher.publish(topic, message, self.qos, self.retain)
+
+    def publish_changed(self, topic, message, now):
+        """
+        Publish message only if it differs from the last one on topic.
+        Unchanged values are still republished every HOMIE_PUBLISH_FORCE_SECONDS.
+        """
+        last = self.published.get(topic)
+        if last != None and last[0] == message:
+            if now - last[1] < HOMIE_PUBLISH_FORCE_SECONDS:
+                return
+        self.published[topic] = (message, now)
+        self.publish(topic, message)
+
+    def forget(self, prefix):
+        """Publish topics under prefix again even if unchanged."""
+        for topic in [t for t in self.published if t.startswith(prefix)]:
+            del self.published[topic]
+
+    def on_publish_dropped(self, topic):
+        # publish it again with the next change or homie_publish_all
+        self.published.pop(topic, None)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+import logging
+
+logger = logging.getLogger("esp_mqtt").getChild(__name__)
+import json
+import os
+from datetime import datetime
+from threading import Lock
+from time import sleep, monotonic
+from urllib.parse import urlparse, parse_qsl, urlencode
+
+from config_defaults import *
+from config import *
+
+import requests
+
+
+def request_key(url):
+    """Endpoint and sorted query of url without the token."""
+    url = urlparse(url)
+    endpoint = url.path.rsplit("/", 1)[-1]
+    query = sorted((k, v) for k, v in parse_qsl(url.query) if k != "token")
+    if query:
+        return "{}?{}".format(endpoint, urlencode(query))
+    return endpoint
+
+
+class Recorded:
+    """Enough of requests.Response for Fetcher."""
+
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class Cassette:
+    def __init__(self, path):
+        """Recorded responses, a JSON line each, grouped by request_key."""
+        self.path = path
+        self.lock = Lock()
+        self.entries = {}
+        self.played = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.entries.setdefault(entry["key"], []).append(entry)
+
+    def append(self, entry):
+        with self.lock:
+            self.entries.setdefault(entry["key"], []).append(entry)
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+    def next(self, key):
+        """Recorded entries for key in order, the last one repeats."""
+        with self.lock:
+            entries = self.entries.get(key)
+            if not entries:
+                return None
+            i = self.played.get(key, 0)
+            self.played[key] = i + 1
+            return entries[min(i, len(entries) - 1)]
+
+
+class RecordingTransport:
+    def __init__(self, session, cassette):
+        """Pass requests to the session and record the responses."""
+        self.session = session
+        self.cassette = cassette
+
+    def get(self, url, **kwargs):
+        start = monotonic()
+        response = self.session.get(url, **kwargs)
+        self.cassette.append(
+            {
+                "key": request_key(url),
+                "time": datetime.now().astimezone().isoformat(),
+                "latency": round(monotonic() - start, 4),
+                "status": response.status_code,
+                "body": response.text,
+            }
+        )
+        return response
+
+
+class ReplayTransport:
+    def __init__(self, cassette, latency=False):
+        """Serve recorded responses offline, optionally as slowly as recorded."""
+        self.cassette = cassette
+        self.latency = latency
+
+    def get(self, url, **kwargs):
+        entry = self.cassette.next(request_key(url))
+        if entry == None:
+            raise requests.ConnectionError(
+                "No recorded response for {}".format(request_key(url))
+            )
+        if self.latency:
+            sleep(entry["latency"])
+        return Recorded(entry["status"], entry["body"])
+
+
+def make_transport(session):
+    """Transport for ESP_API_CASSETTE_MODE, the session itself for passthrough."""
+    if ESP_API_CASSETTE_MODE == "passthrough":
+        return session
+    if ESP_API_CASSETTE == None:
+        raise ValueError(
+            "ESP_API_CASSETTE is needed for {} mode".format(ESP_API_CASSETTE_MODE)
+        )
+    cassette = Cassette(ESP_API_CASSETTE)
+    if ESP_API_CASSETTE_MODE == "record":
+        logger.info("Recording API responses to {}.".format(ESP_API_CASSETTE))
+        return RecordingTransport(session, cassette)
+    if ESP_API_CASSETTE_MODE == "replay":
+        logger.info("Replaying API responses from {}.".format(ESP_API_CASSETTE))
+        return ReplayTransport(cassette, ESP_API_CASSETTE_LATENCY)
+    raise ValueError("Unknown ESP_API_CASSETTE_MODE {}".format(ESP_API_CASSETTE_MODE))
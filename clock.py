@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+import logging
+
+logger = logging.getLogger("esp_mqtt").getChild(__name__)
+from datetime import datetime, timedelta
+from time import monotonic
+
+
+class Clock:
+    """Wall and monotonic time of the system."""
+
+    def now(self, tz=None):
+        return datetime.now(tz)
+
+    def monotonic(self):
+        return monotonic()
+
+
+class VirtualClock(Clock):
+    def __init__(self, start):
+        """
+        Simulated time that only moves when advanced, so a day of
+        scheduling can run in a moment.  start is an aware datetime, the
+        wall time at monotonic 0.
+        """
+        self.start = start
+        self.elapsed = 0.0
+
+    def now(self, tz=None):
+        now = self.start + timedelta(seconds=self.elapsed)
+        if tz != None:
+            return now.astimezone(tz)
+        return now.replace(tzinfo=None)
+
+    def monotonic(self):
+        return self.elapsed
+
+    def advance_to(self, monotonic):
+        if monotonic > self.elapsed:
+            self.elapsed = monotonic
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+import logging
+
+logger = logging.getLogger("esp_mqtt").getChild(__name__)
+from functools import partial
+
+from config_defaults import *
+from config import *
+import metrics
+
+# (node, property) set topic -> command, $init is set on the device itself
+COMMANDS = {
+    ("api", "refresh"): "refresh",
+    ("status", "republish"): "republish",
+    ("$init",): "init",
+}
+
+
+class Commands:
+    def __init__(self, esp):
+        """
+        Run commands set over MQTT: api/refresh fetches the device's area,
+        status/republish publishes its values again and $init its whole
+        tree as well.
+
+        Requests for a device within ESP_COMMAND_WINDOW_SECONDS are merged
+        into one run and each command runs at most once per
+        ESP_COMMAND_MIN_SECONDS for a device.  An on demand refresh leaves
+        ESP_COMMAND_API_RESERVE calls on top of ESP_API_RESERVE for the
+        planned refreshes.
+        """
+        self.esp = esp
+        self.actions = {
+            "refresh": self.refresh,
+            "republish": esp.republish_area,
+            "init": esp.init_area,
+        }
+        # monotonic time of the last run by (command, area_id)
+        self.last_run = {}
+        self.topics = []
+
+    def add_routes(self, routes):
+        """Route the set topic of each command of every area to message."""
+        for area in self.esp.all_areas:
+            for levels, command in COMMANDS.items():
+                topic = "/".join((area.device.base_topic,) + levels + ("set",))
+                routes.add(topic, partial(self.message, command, area))
+                self.topics.append(topic)
+
+    def subscriptions(self):
+        return self.topics
+
+    def message(self, command, area, topic, payload):
+        """Handle a message on a set topic.  Runs on the scheduler thread."""
+        payload = payload.decode("utf-8")
+        logger.debug("message topic={}, message={}".format(topic, payload))
+        if area not in self.esp.areas:
+            # served by another worker
+            return
+        if payload != "true":
+            logger.info("Ignored {} for {}: {}".format(command, area.area_id, payload))
+            return
+        self.request(command, area)
+
+    def request(self, command, area):
+        job = "command/{}/{}".format(command, area.area_id)
+        if self.esp.scheduler.pending(job):
+            metrics.COMMANDS.inc(command, "merged")
+            return
+        self.esp.scheduler.schedule(
+            job, ESP_COMMAND_WINDOW_SECONDS, partial(self.run, command, area)
+        )
+
+    def run(self, command, area):
+        job = "command/{}/{}".format(command, area.area_id)
+        if command == "refresh" and self.esp.refreshing:
+            # one fetch at a time, try again when this one is done
+            self.esp.scheduler.schedule(job, 1, partial(self.run, command, area))
+            return
+        now = self.esp.clock.monotonic()
+        last = self.last_run.get((command, area.area_id))
+        if last != None and now - last < ESP_COMMAND_MIN_SECONDS[command]:
+            logger.info(
+                "Rate limited {} for {}, last run {:.0f}s ago.".format(
+                    command, area.area_id, now - last
+                )
+            )
+            metrics.COMMANDS.inc(command, "limited")
+            return
+        if self.actions[command](area) == False:
+            metrics.COMMANDS.inc(command, "refused")
+            return
+        logger.info("Ran {} for {}.".format(command, area.area_id))
+        self.last_run[command, area.area_id] = now
+        metrics.COMMANDS.inc(command, "run")
+
+    def refresh(self, area):
+        quota = self.esp.quota
+        if quota.known() and quota.remaining() <= (
+            ESP_API_RESERVE + ESP_COMMAND_API_RESERVE
+        ):
+            logger.warning(
+                "Refused refresh for {}, {} API calls left.".format(
+                    area.area_id, quota.remaining()
+                )
+            )
+            return False
+        self.esp.refresh(area)
@@ -18,12 +18,62 @@ MQTT_KEEPALIVE = 60
 MQTT_CLIENT_ID = "esp_mqtt"
 MQTT_USERNAME = None
 MQTT_PASSWORD = None
+# or a list of brokers to publish to, each a dict with host and optionally name,
+# port, username, password, client_id, keepalive, qos, retain, reconnect_min
+# and reconnect_max
+MQTT_BROKERS = None
+MQTT_RECONNECT_MIN_SECONDS = 1  # reconnect backoff doubles from this
+MQTT_RECONNECT_MAX_SECONDS = 60  # up to this
+MQTT_MAX_INFLIGHT = 20  # messages handed to the client before acknowledgement
+MQTT_MAX_QUEUED = 5000  # oldest queued messages are dropped beyond this
 
 # ESP API
 ESP_API_URL = "https://developer.sepush.co.za/business/2.0/"
 ESP_AREA_ID = "capetown-7-gardens"
+# Serve several areas from one process, e.g. ["capetown-7-gardens", "eskde-10-fourwaysext10cityofjohannesburggauteng"].
+# Each area is published as Homie device HOMIE_DEVICE_ID-<area id>.  A dict maps area ids to device ids.
+ESP_AREAS = None
 ESP_TEST = False
-ESP_REFRESH_API_COUNTS_SECONDS = 10 * 60  # 10 minutes
+# Work out outages locally from each area's cached stage timetable and the
+# national stage.  One `status` call then refreshes every area and `area` is
+# only fetched again when the cached timetable runs out.
+ESP_LOCAL_SCHEDULE = False
+ESP_REFRESH_API_COUNTS_SECONDS = 10 * 60  # allowance check when sharded
+ESP_API_RECONCILE_SECONDS = 6 * 60 * 60  # otherwise calls are counted locally
+ESP_API_RETRY_SECONDS = 60  # retry delay after a failed area fetch
+# Planning of API calls over the day: "even" or "adaptive"
+ESP_PLANNER = "even"
+ESP_API_RESERVE = 0  # calls per day never used by scheduled refreshes
+# adaptive planner: relative value of fresh data by hour of day
+ESP_PLANNER_HOUR_WEIGHTS = [0.25] * 5 + [1] * 19
+ESP_PLANNER_EVENT_SECONDS = 2 * 3600  # window before a scheduled start
+ESP_PLANNER_EVENT_WEIGHT = 4
+ESP_PLANNER_CHANGE_SECONDS = 3600  # window after a schedule change or failed fetch
+ESP_PLANNER_CHANGE_WEIGHT = 3
+ESP_PLANNER_FAILED_WEIGHT = 2
+ESP_API_CONNECT_TIMEOUT = 5
+ESP_API_READ_TIMEOUT = 30
+ESP_API_RETRIES = 3  # retries of a single request on network or server errors
+ESP_API_BACKOFF_SECONDS = 1  # exponential backoff base with jitter
+ESP_API_BACKOFF_MAX_SECONDS = 30
+ESP_API_CASSETTE_MODE = "passthrough"  # or "record" or "replay"
+ESP_API_CASSETTE = None  # file of recorded responses, e.g. "/opt/esp_mqtt/api.jsonl"
+ESP_API_CASSETTE_LATENCY = False  # replay with the recorded latency
+ESP_PRECISE_TRANSITIONS = True  # publish status changes at the exact instant
+ESP_CLOCK_CHECK_SECONDS = 60  # look for wall clock steps this often
+ESP_CLOCK_STEP_SECONDS = 0.05  # larger wall clock changes move scheduled jobs
+ESP_SHARD_WORKER = None  # a name unique to each worker splits ESP_AREAS between them
+ESP_SHARD_LEASE_SECONDS = 60  # an area lease expires unless renewed within this
+ESP_SHARD_SETTLE_SECONDS = 2  # wait this long for the other workers after connecting
+ESP_SHARD_REPLICAS = 64  # points per worker on the hash ring
+ESP_COMMAND_WINDOW_SECONDS = 2  # commands set within this run once
+# each command runs at most this often for a device
+ESP_COMMAND_MIN_SECONDS = {"refresh": 5 * 60, "republish": 10, "init": 60}
+ESP_COMMAND_API_RESERVE = 5  # calls on demand refreshes leave for planned ones
+ESP_ARCHIVE_DIR = None  # or a directory to archive every schedule and transition in
+ESP_ARCHIVE_SEGMENT_BYTES = 16 * 1024 * 1024  # start a new archive segment after this
+# Save fetched schedules so restarts do not spend API calls
+ESP_STATE_FILE = None  # or a file path, e.g. "/opt/esp_mqtt/esp_state.json"
 
 # Homie Standard Items
 # https://homieiot.github.io/specification/spec-core-v4_0_0/
@@ -36,9 +86,21 @@ HOMIE_DEVICE_EXTENSIONS = ""
 HOMIE_INIT_SECONDS = 3600 * 24  # Daily
 HOMIE_MQTT_QOS = 1
 HOMIE_MQTT_RETAIN = True
+HOMIE_READY_AFTER_ACKS = True  # $state ready only once the $ tree is acknowledged
 HOMIE_PUBLISH_ALL_SECONDS = 60
+HOMIE_PUBLISH_FORCE_SECONDS = 3600  # republish unchanged values this often
 HOMIE_IMPLEMENTATION = "esp_mqtt"
-HOMIE_MAX_EVENTS = 3
+HOMIE_MAX_EVENTS = 3  # event1..eventN nodes with the next events, 0 for none
+HOMIE_SCHEDULE_PROPERTY = False  # schedule/events holds all upcoming events as JSON
+
+# Home Assistant
+HASS_DISCOVERY = False  # also publish Home Assistant MQTT discovery config
+HASS_DISCOVERY_PREFIX = "homeassistant"
+
+# Metrics
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = None  # or set a port to serve Prometheus metrics on /metrics
+HOMIE_STATS_SECONDS = None  # or publish a metrics summary as Homie $stats this often
 
 # TZ
 TIMEZONE = "Africa/Johannesburg"
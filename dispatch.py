@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+import logging
+
+logger = logging.getLogger("esp_mqtt").getChild(__name__)
+
+# key of the handler in a trie node, never a topic level
+HANDLER = None
+
+
+class TopicTrie:
+    def __init__(self):
+        """
+        Handlers by MQTT topic filter, one trie level per topic level with
+        + and # wildcards.  A topic that matches nothing is rejected at the
+        first level that differs.  Built before connecting and only read
+        after, so it is safe to match from paho's network thread.
+        """
+        self.root = {}
+        self.filters = []
+
+    def add(self, topic_filter, handler):
+        node = self.root
+        for level in topic_filter.split("/"):
+            node = node.setdefault(level, {})
+        node[HANDLER] = handler
+        self.filters.append(topic_filter)
+
+    def match(self, topic):
+        """Handler for topic, exact levels before + before #, or None."""
+        return self._match(self.root, topic.split("/"), 0)
+
+    def _match(self, node, levels, i):
+        if i == len(levels):
+            handler = node.get(HANDLER)
+            if handler == None and "#" in node:
+                # # also matches the parent level
+                handler = node["#"].get(HANDLER)
+            return handler
+        for key in (levels[i], "+"):
+            child = node.get(key)
+            if child != None:
+                handler = self._match(child, levels, i + 1)
+                if handler != None:
+                    return handler
+        if "#" in node:
+            return node["#"].get(HANDLER)
+        return None
@@ -2,535 +2,380 @@
 import logging
 
 logger = logging.getLogger("esp_mqtt").getChild(__name__)
-from time import sleep, time
+from time import sleep, time, monotonic, perf_counter
 from datetime import datetime, timedelta, time
-import paho.mqtt.client as mqtt
+import re
+import os
+import json
+import tempfile
 
 from config_defaults import *
 from config import *
 from pprint import pprint
 from pytz import timezone
-
-import requests
+from functools import partial
+from clock import Clock
+from scheduler import Scheduler
+import metrics
+from broker import Broker, configured_brokers, will_topic
+from commands import Commands
+from dispatch import TopicTrie
+from shard import Shard
+from fetcher import Fetcher
+from timeline import Timeline, Event, FAR_AWAY, to_datetime
+from hass import discovery_messages
+from homie import (
+    Device,
+    AREA_NODE,
+    API_NODE,
+    STATUS_NODE,
+    SCHEDULE_NODE,
+    event_node,
+    encode_datetime,
+    encode_payload,
+    encode_value,
+)
+from planner import Hints, make_planner
+from quota import QuotaLedger
+from archive import Archive
+from timetable import Timetable, parse_stages, region_for_area
+
+
+# fetch_refresh response when too few calls remain to fetch
+SKIPPED = object()
+
+
+def configured_areas():
+    """Return a list of (area_id, device_id) pairs from the config."""
+    if ESP_AREAS == None:
+        return [(ESP_AREA_ID, HOMIE_DEVICE_ID)]
+    if isinstance(ESP_AREAS, dict):
+        return list(ESP_AREAS.items())
+    if len(ESP_AREAS) == 1:
+        return [(ESP_AREAS[0], HOMIE_DEVICE_ID)]
+    areas = []
+    for area_id in ESP_AREAS:
+        # homie ids are lowercase letters, digits and hyphens
+        device_id = re.sub("[^a-z0-9-]", "-", area_id.lower())
+        areas.append((area_id, "{}-{}".format(HOMIE_DEVICE_ID, device_id)))
+    return areas
 
 
 class ESP:
-    def __init__(self):
-        """Intialise ESP"""
+    def __init__(
+        self, clock=None, client=None, fetcher=Fetcher, state_file=ESP_STATE_FILE
+    ):
+        """
+        Intialise ESP
+
+        clock, the MQTT client (of the first broker only) and the fetcher
+        (called with the scheduler) can be swapped, for example for a replay.
+        """
         logger.debug("Initialising ESP class...")
-        # mqtt client
-        self.mqtt = mqtt.Client(client_id=MQTT_CLIENT_ID)
-        self.mqtt.on_connect = self.on_mqtt_connect
-        self.mqtt.on_disconnect = self.on_mqtt_disconnect
-        self.mqtt.on_message = self.homie_message
-
-        # MQTT Will
-        topic = "{}/{}/{}".format(HOMIE_BASE_TOPIC, HOMIE_DEVICE_ID, "$state")
-        self.mqtt.will_set(
-            topic, payload="lost", qos=HOMIE_MQTT_QOS, retain=HOMIE_MQTT_RETAIN
-        )
+        if clock == None:
+            clock = Clock()
+        self.clock = clock
+        self.state_file = state_file
+
+        # areas, with sharding only those this worker serves are in areas
+        self.all_areas = []
+        for area_id, device_id in configured_areas():
+            self.all_areas.append(Area(self, area_id, device_id))
+        if ESP_SHARD_WORKER != None:
+            self.shard = Shard(self, ESP_SHARD_WORKER)
+            self.areas = []
+        else:
+            self.shard = None
+            self.areas = list(self.all_areas)
+        if HASS_DISCOVERY:
+            will = will_topic(self)
+            for area in self.all_areas:
+                area.discovery_messages = discovery_messages(area.device, will)
 
-        # area
-        self.area_id = ESP_AREA_ID
-        self.area_name = None
-        self.region_name = None
+        self.started = self.clock.monotonic()
 
-        # events
-        self.events = []
+        # national stage for ESP_LOCAL_SCHEDULE
+        self.status_response = None
+        self.status_update = None
 
         # API related
-        # last update from API
-        self.last_api_update = None
         self.next_api_update = datetime(1900, 1, 1, 0, 0, 0, 0, timezone(TIMEZONE))
+        self.planner = make_planner()
+        self.schedule_changed = None
+        self.failed_update = None
 
-        # API allowance
-        self.api_count = None
-        self.api_limit = None
-        self.api_limit_type = None
+        # API allowance, other workers spend the same quota when sharded
+        if ESP_SHARD_WORKER != None:
+            self.quota = QuotaLedger(clock, ESP_REFRESH_API_COUNTS_SECONDS)
+        else:
+            self.quota = QuotaLedger(clock)
 
-        # status
-        self.status_loadshedding = None
-        self.status_loadshedding_next_start = FAR_AWAY_DATE
-        self.status_loadshedding_next_end = FAR_AWAY_DATE
-        self.status_loadshedding_end = FAR_AWAY_DATE
-        self.status_warning_5min = None
-        self.status_warning_15min = None
-        self.status_note = None
+        # history of schedules and transitions, see archive.py
+        self.archive = None if ESP_ARCHIVE_DIR == None else Archive(ESP_ARCHIVE_DIR)
 
         # timers
-        self.homie_init_time = datetime(1900, 1, 1, 0, 0, 0, 0, timezone(TIMEZONE))
-        self.homie_publish_all_time = datetime(
-            1900, 1, 1, 0, 0, 0, 0, timezone(TIMEZONE)
-        )
-        self.esp_api_counts_refresh_time = datetime(
-            1900, 1, 1, 0, 0, 0, 0, timezone(TIMEZONE)
-        )
-        self.next_status_time = datetime(1900, 1, 1, 0, 0, 0, 0, timezone(TIMEZONE))
+        clock_check = ESP_CLOCK_CHECK_SECONDS if ESP_PRECISE_TRANSITIONS else None
+        self.scheduler = Scheduler(clock_check, ESP_CLOCK_STEP_SECONDS, clock)
+        # each broker runs homie_init when it connects
+        self.scheduler.schedule("homie_init", HOMIE_INIT_SECONDS, self.homie_init)
+
+        # incoming messages by topic, commands on our own devices only
+        self.routes = TopicTrie()
+        self.commands = Commands(self)
+        self.commands.add_routes(self.routes)
+
+        # MQTT connections, each with its own windowed publisher
+        if client == None:
+            self.brokers = [Broker(self, b) for b in configured_brokers()]
+        else:
+            self.brokers = [Broker(self, configured_brokers()[0], client)]
+        if self.shard != None:
+            self.shard.attach(self.brokers[0], self.routes)
 
-        self.mqtt_connect(
-            host=MQTT_HOST,
-            port=MQTT_PORT,
-            username=MQTT_USERNAME,
-            password=MQTT_PASSWORD,
-        )
-        self.do_homie_init = True
+        # connect in the background while the state loads and the first
+        # fetch runs, whatever is published meanwhile waits in the queue
+        for broker in self.brokers:
+            broker.connect()
 
-        logger.debug("Initialised ESP class.")
+        # API requests run in the background
+        self.fetcher = fetcher(self.scheduler)
+        self.refreshing = False
 
-    def on_mqtt_connect(self, client, userdata, flags, rc):
-        if rc == 0:
-            logger.info("Connected to MQTT...")
-            self.mqtt.subscribe(
-                "{}/{}/{}/{}/{}/{}".format(HOMIE_BASE_TOPIC, "+", "+", "+", "set", "#")
-            )
-            self.do_homie_init = True
-        else:
-            logger.info("Connectetion to MQTT failed return code of {}.".format(rc))
-
-    def on_mqtt_disconnect(self, client, userdata, rc):
-        logger.info("MQTT was disconnected with return code of {}".format(rc))
-
-    def mqtt_connect(
-        self,
-        host="localhost",
-        port=1883,
-        username=None,
-        password=None,
-        keepalive=60,
-        bind_address="",
-    ):
-        logger.info("Connecting to mqtt.")
+        # state saved by a previous run
+        self.state_loaded = self.load_state()
 
-        if username != None and password != None:
-            self.mqtt.username_pw_set(username=username, password=password)
-        error = True
-        while error:
-            try:
-                self.mqtt.connect(host, port, keepalive, bind_address)
-                error = False
-            except Exception as e:
-                logger.error("{} for MQTT.  Retrying...".format(e))
-                error = True
-                sleep(5)
-        self.mqtt.loop_start()
+        logger.debug("Initialised ESP class.")
 
     def homie_publish(self, topic, message):
-        self.mqtt.publish(
-            topic=topic, payload=message, qos=HOMIE_MQTT_QOS, retain=HOMIE_MQTT_RETAIN
-        )
+        message = encode_payload(message)
+        for broker in self.brokers:
+            broker.publish(topic, message)
+
+    def homie_publish_changed(self, topic, message):
+        """Publish message to every broker that was not sent it last."""
+        message = encode_payload(message)
+        now = self.clock.monotonic()
+        for broker in self.brokers:
+            broker.publish_changed(topic, message, now)
 
     def homie_message(self, client, userdata, message):
-        logger.info(
-            "message topic={}, message={}".format(
-                message.topic, str(message.payload.decode("utf-8"))
-            )
-        )
+        # on paho's network thread, only look the topic up
+        handler = self.routes.match(message.topic)
+        if handler != None:
+            self.scheduler.call_soon(partial(handler, message.topic, message.payload))
 
-        # do nothing as this is one way traffic
-        pass
+    def republish_area(self, area):
+        """Publish every value of area again, changed or not."""
+        for broker in self.brokers:
+            broker.forget(area.device.base_topic + "/")
+        area.homie_publish_all()
 
-    def main_loop(self):
-        """Wait for and then process messages."""
-        while True:
-            sleep(5)
-            now = datetime.now(timezone(TIMEZONE))
-            if self.do_homie_init or now > self.homie_init_time + timedelta(seconds=HOMIE_INIT_SECONDS):
-                self.homie_init()
-            elif now > self.next_api_update:
-                self.get_area()
-                self.update_loadshedding_status()
-                self.homie_publish_all()
-            elif now > self.next_status_time:
-                self.update_loadshedding_status()
-                self.homie_publish_all()
-            elif now > self.homie_publish_all_time + timedelta(
-                seconds=HOMIE_PUBLISH_ALL_SECONDS
-            ):
-                self.update_loadshedding_status()
-                self.homie_publish_all()
-            elif now > self.esp_api_counts_refresh_time + timedelta(
-                seconds=ESP_REFRESH_API_COUNTS_SECONDS
-            ):
-                self.get_api()
-                self.homie_publish_all()
+    def init_area(self, area):
+        area.homie_init(self.brokers)
+        self.republish_area(area)
 
-    def homie_publish_device_state(self, state):
-        topic = "{}/{}/{}".format(HOMIE_BASE_TOPIC, HOMIE_DEVICE_ID, "$state")
-        self.homie_publish(topic, state)
-
-    def homie_init(self):
-        # device to init
-        self.homie_init_device()
-        self.homie_init_area()
-        self.homie_init_api()
-        self.homie_init_status()
-        # self.homie_init_events()
-
-        # device ready
-        self.homie_publish_device_state("ready")
-        self.homie_init_time = datetime.now(timezone(TIMEZONE))
-        self.do_homie_init = False
-
-    def homie_init_device(self):
-        topic = "{}/{}/{}".format(HOMIE_BASE_TOPIC, HOMIE_DEVICE_ID, "$homie")
-        self.homie_publish(topic, HOMIE_DEVICE_VERSION)
-        topic = "{}/{}/{}".format(HOMIE_BASE_TOPIC, HOMIE_DEVICE_ID, "$name")
-        self.homie_publish(topic, HOMIE_DEVICE_NAME)
-        self.homie_publish_device_state("init")
-        topic = "{}/{}/{}".format(HOMIE_BASE_TOPIC, HOMIE_DEVICE_ID, "$nodes")
-        nodes = "area,api,status"  # ,event1,event2,event3"
-        self.homie_publish(topic, nodes)
-        topic = "{}/{}/{}".format(HOMIE_BASE_TOPIC, HOMIE_DEVICE_ID, "$extensions")
-        self.homie_publish(topic, "")
-        topic = "{}/{}/{}".format(HOMIE_BASE_TOPIC, HOMIE_DEVICE_ID, "$implementation")
-        self.homie_publish(topic, HOMIE_IMPLEMENTATION)
-
-    def homie_publish_all(self, init=False):
-        self.homie_publish_area()
-        self.homie_publish_api()
-        # self.homie_publish_events()
-        self.homie_publish_status()
-        self.homie_publish_all_time = datetime.now(timezone(TIMEZONE))
-
-    def homie_init_node(self, node_id, name, type=None, properties=None):
-        topic = "{}/{}/{}/{}".format(
-            HOMIE_BASE_TOPIC, HOMIE_DEVICE_ID, node_id, "$name"
-        )
-        self.homie_publish(topic, name)
-        if type != None:
-            topic = "{}/{}/{}/{}".format(
-                HOMIE_BASE_TOPIC, HOMIE_DEVICE_ID, node_id, "$type"
-            )
-            self.homie_publish(topic, type)
-        if properties != None:
-            topic = "{}/{}/{}/{}".format(
-                HOMIE_BASE_TOPIC, HOMIE_DEVICE_ID, node_id, "$properties"
+    def main_loop(self):
+        """Run each job as its deadline comes due."""
+        self.start()
+        self.scheduler.run_forever()
+
+    def start(self):
+        """Arm the first jobs."""
+        if HOMIE_STATS_SECONDS != None:
+            self.scheduler.schedule(
+                "homie_publish_stats", HOMIE_STATS_SECONDS, self.homie_publish_stats
             )
-            self.homie_publish(topic, properties)
-
-    def homie_message_boolean(self, value):
-        if value:
-            return "true"
-        else:
-            return "false"
-
-    def homie_publish_boolean(self, topic, value):
-        message = self.homie_message_boolean(value)
-        self.homie_publish(topic, message)
-
-    def homie_message_datetime(self, value):
-        if value == None:
-            return ""
-        else:
-            return value.isoformat()
-
-    def homie_publish_property(self, node_id, property_id, datatype, value=None):
-        if value != None:
-            topic = "{}/{}/{}/{}".format(
-                HOMIE_BASE_TOPIC, HOMIE_DEVICE_ID, node_id, property_id
+        if self.state_loaded:
+            # publish the saved schedule now and only refresh when it is due
+            for area in self.areas:
+                if area.last_api_update != None:
+                    area.status_refresh()
+            self.schedule_quota_reset()
+        self.schedule_api_refresh()
+
+    def schedule_api_refresh(self, retry=False):
+        delay = (
+            self.next_api_update - self.clock.now(timezone(TIMEZONE))
+        ).total_seconds()
+        # failed fetches leave next_api_update in the past so back off
+        if retry and delay < ESP_API_RETRY_SECONDS:
+            delay = ESP_API_RETRY_SECONDS
+        self.scheduler.schedule("api_refresh", delay, self.api_refresh)
+
+    def api_refresh(self):
+        if self.refreshing:
+            # api_refreshed schedules the next refresh
+            return
+        if not self.areas:
+            # set_areas schedules a refresh for new areas
+            return
+        self.refresh(self.next_area_to_refresh())
+
+    def refresh(self, area):
+        """Fetch area, or the status when area is None, in the background."""
+        self.refreshing = True
+        # the ledger answers unless the allowance needs checking
+        remaining = None if self.quota.reconcile_due() else self.quota.remaining()
+        self.fetcher.submit(
+            partial(self.fetch_refresh, area, remaining),
+            partial(self.api_refreshed, area),
+        )
+
+    def fetch_refresh(self, area, remaining=None):
+        """
+        Fetch area (or status when area is None) if the remaining calls
+        allow, fetching the allowance first when remaining is None.  The
+        response is SKIPPED when they do not.  Runs on the fetch thread.
+        """
+        allowance = None
+        if remaining == None:
+            allowance = self.fetch_api()
+            if allowance == None:
+                return None, None
+            remaining = (
+                allowance["allowance"]["limit"] - allowance["allowance"]["count"]
             )
-            if datatype == "boolean":
-                message = self.homie_message_boolean(value)
-            elif datatype == "datetime":
-                message = self.homie_message_datetime(value)
+        response = SKIPPED
+        if remaining > ESP_API_RESERVE:
+            if area == None:
+                response = self.fetch_status()
             else:
-                message = value
-            self.homie_publish(topic, message)
-
-    def homie_init_property(
-        self,
-        node_id,
-        property_id,
-        name,
-        datatype,
-        format=None,
-        settable=False,
-        retained=True,
-        unit=None,
-    ):
-        topic = "{}/{}/{}/{}/{}".format(
-            HOMIE_BASE_TOPIC, HOMIE_DEVICE_ID, node_id, property_id, "$name"
-        )
-        self.homie_publish(topic, name)
-        if datatype == "datetime":
-            datatype = "string"
-        topic = "{}/{}/{}/{}/{}".format(
-            HOMIE_BASE_TOPIC, HOMIE_DEVICE_ID, node_id, property_id, "$datatype"
-        )
-        self.homie_publish(topic, datatype)
-        if format != None:
-            topic = "{}/{}/{}/{}/{}".format(
-                HOMIE_BASE_TOPIC, HOMIE_DEVICE_ID, node_id, property_id, "$format"
-            )
-            self.homie_publish(topic, format)
-        topic = "{}/{}/{}/{}/{}".format(
-            HOMIE_BASE_TOPIC, HOMIE_DEVICE_ID, node_id, property_id, "$settable"
-        )
-        self.homie_publish_boolean(topic, settable)
-        topic = "{}/{}/{}/{}/{}".format(
-            HOMIE_BASE_TOPIC, HOMIE_DEVICE_ID, node_id, property_id, "$retained"
-        )
-        self.homie_publish_boolean(topic, retained)
-        if unit != None:
-            topic = "{}/{}/{}/{}/{}".format(
-                HOMIE_BASE_TOPIC, HOMIE_DEVICE_ID, node_id, property_id, "$unit"
-            )
-            self.homie_publish(topic, unit)
+                response = area.fetch_area()
+        return allowance, response
 
-    def homie_init_area(self):
-        self.homie_init_node(
-            node_id="area",
-            name="Area",
-            properties="areaid,areaname,regionname",
-        )
-        self.homie_init_property(
-            node_id="area",
-            property_id="areaid",
-            name="Area ID",
-            datatype="string",
-        )
-        self.homie_init_property(
-            node_id="area",
-            property_id="areaname",
-            name="Area Name",
-            datatype="string",
-        )
-        self.homie_init_property(
-            node_id="area",
-            property_id="regionname",
-            name="Region Name",
-            datatype="string",
-        )
-
-    def homie_init_api(self):
-        self.homie_init_node(
-            node_id="api",
-            name="API",
-            properties="lastapiupdate,apicount,apilimit,apilimittype",
-        )
-        self.homie_init_property(
-            node_id="api",
-            property_id="lastapiupdate",
-            name="Last Update",
-            datatype="datetime",
-        )
-        self.homie_init_property(
-            node_id="api",
-            property_id="apicount",
-            name="API Count",
-            datatype="integer",
-        )
-        self.homie_init_property(
-            node_id="api",
-            property_id="apilimit",
-            name="API Limit",
-            datatype="integer",
-        )
-        self.homie_init_property(
-            node_id="api",
-            property_id="apilimittype",
-            name="API Limit Type",
-            datatype="string",
-        )
-
-    def homie_init_status(self):
-        self.homie_init_node(
-            node_id="status",
-            name="Loadshedding status",
-            properties="loadshedding,warning15min,warning5min,loadsheddingnextstart,loadsheddingnextend,loadsheddingend,note",
-        )
-        self.homie_init_property(
-            node_id="status",
-            property_id="loadshedding",
-            name="Current Loadshedding",
-            datatype="boolean",
-        )
-        self.homie_init_property(
-            node_id="status",
-            property_id="warning15min",
-            name="Loadshedding 15 minute Warning",
-            datatype="boolean",
-        )
-        self.homie_init_property(
-            node_id="status",
-            property_id="warning5min",
-            name="Loadshedding 5 minute Warning",
-            datatype="boolean",
-        )
-        self.homie_init_property(
-            node_id="status",
-            property_id="loadsheddingnextstart",
-            name="Loadshedding Start Time",
-            datatype="datetime",
-        )
-        self.homie_init_property(
-            node_id="status",
-            property_id="loadsheddingnextend",
-            name="Loadshedding End Time",
-            datatype="datetime",
-        )
-        self.homie_init_property(
-            node_id="status",
-            property_id="loadsheddingend",
-            name="Loadshedding End Time",
-            datatype="datetime",
-        )
-        self.homie_init_property(
-            node_id="status",
-            property_id="note",
-            name="Status Note",
-            datatype="string",
-        )
-
-    def homie_publish_status(self):
-        self.homie_publish_property(
-            node_id="status",
-            property_id="loadshedding",
-            datatype="boolean",
-            value=self.status_loadshedding,
-        )
-        self.homie_publish_property(
-            node_id="status",
-            property_id="warning5min",
-            datatype="boolean",
-            value=self.status_warning_5min,
-        )
-        self.homie_publish_property(
-            node_id="status",
-            property_id="warning15min",
-            datatype="boolean",
-            value=self.status_warning_15min,
-        )
-        self.homie_publish_property(
-            node_id="status",
-            property_id="loadsheddingnextstart",
-            datatype="datetime",
-            value=self.status_loadshedding_next_start,
-        )
-        self.homie_publish_property(
-            node_id="status",
-            property_id="loadsheddingnextend",
-            datatype="datetime",
-            value=self.status_loadshedding_next_end,
-        )
-        self.homie_publish_property(
-            node_id="status",
-            property_id="loadsheddingend",
-            datatype="datetime",
-            value=self.status_loadshedding_end,
-        )
-        self.homie_publish_property(
-            node_id="status",
-            property_id="note",
-            datatype="string",
-            value=self.status_note,
-        )
-
-    def homie_publish_area(self):
-        self.homie_publish_property(
-            node_id="area",
-            property_id="areaid",
-            datatype="string",
-            value=self.area_id,
-        )
-        self.homie_publish_property(
-            node_id="area",
-            property_id="areaname",
-            datatype="string",
-            value=self.area_name,
-        )
-        self.homie_publish_property(
-            node_id="area",
-            property_id="regionname",
-            datatype="string",
-            value=self.region_name,
-        )
-
-    def homie_init_events(self):
-        for i in range(1, HOMIE_MAX_EVENTS + 1):
-            node_id = "event{}".format(i)
-            self.homie_init_node(
-                node_id=node_id,
-                name="Event {}".format(i),
-                type=None,
-                properties="start,end,note",
-            )
-            self.homie_init_property(
-                node_id=node_id,
-                property_id="start",
-                name="Start Time",
-                datatype="datetime",
-                settable=False,
-            )
-            self.homie_init_property(
-                node_id=node_id,
-                property_id="end",
-                name="End Time",
-                datatype="datetime",
-                settable=False,
-            )
-            self.homie_init_property(
-                node_id=node_id,
-                property_id="node",
-                name="Note",
-                datatype="string",
-                settable=False,
-            )
-
-    def homie_publish_events(self):
-        for i in range(1, HOMIE_MAX_EVENTS + 1):
-            node_id = "event{}".format(i)
-            if len(self.events) >= i:
-                event = self.events[i - 1]
+    def api_refreshed(self, area, result):
+        allowance, response = result or (None, None)
+        loaded = False
+        try:
+            loaded = self.load_refreshed(area, allowance, response)
+            # publish first, the status is what subscribers are waiting for
+            if area == None:
+                for a in self.areas:
+                    a.status_refresh()
             else:
-                event = {
-                    "start": None,
-                    "end": None,
-                    "note": None,
-                }
-            self.homie_publish_property(
-                node_id=node_id,
-                property_id="start",
-                datatype="datetime",
-                value=event["start"],
-            )
-            self.homie_publish_property(
-                node_id=node_id,
-                property_id="end",
-                datatype="datetime",
-                value=event["end"],
+                area.status_refresh()
+            self.quota_changed()
+        finally:
+            # whatever went wrong above, keep refreshing
+            self.refreshing = False
+            self.schedule_api_refresh(retry=not loaded)
+
+    def load_refreshed(self, area, allowance, response):
+        """
+        Take in a fetch_refresh result.  Returns False if the fetch failed,
+        a refresh skipped for the quota waits for the reset.
+        """
+        now = self.clock.now(timezone(TIMEZONE))
+        if allowance != None:
+            self.quota.reconcile(allowance)
+        if response is SKIPPED:
+            logger.info(
+                "Skipped refresh, {} API calls left.".format(self.quota.remaining())
             )
-            self.homie_publish_property(
-                node_id=node_id,
-                property_id="note",
-                datatype="string",
-                value=event["note"],
+            return True
+        if response == None:
+            self.failed_update = now
+            self.quota.failed()
+            return False
+        self.quota.charge()
+        before = [(a.timeline.starts, a.timeline.ends) for a in self.areas]
+        if area == None:
+            self.load_status(response)
+            self.status_update = now
+            for a in self.areas:
+                if a.timetable != None:
+                    a.last_api_update = now
+        else:
+            area.load_area(response)
+            area.last_api_update = now
+            area.last_area_fetch = now
+        after = [(a.timeline.starts, a.timeline.ends) for a in self.areas]
+        if before != after:
+            self.schedule_changed = now
+        if self.archive != None:
+            for a in self.areas if area == None else [area]:
+                self.archive.schedule(a.area_id, now.timestamp(), a.events)
+        return True
+
+    def quota_changed(self):
+        if self.quota.known():
+            metrics.API_COUNT.set(self.quota.count)
+            metrics.API_LIMIT.set(self.quota.limit)
+            metrics.API_REMAINING.set(self.quota.remaining())
+            self.update_next_api_update()
+        self.schedule_quota_reset()
+        self.save_state()
+        self.scheduler.schedule("homie_publish_all", 0, self.homie_publish_all)
+
+    def schedule_quota_reset(self):
+        if self.quota.reset != None:
+            self.scheduler.schedule_at(
+                "quota_reset", self.quota.reset, self.quota_reset
             )
 
-    def homie_publish_api(self):
-        self.homie_publish_property(
-            node_id="api",
-            property_id="lastapiupdate",
-            datatype="datetime",
-            value=self.last_api_update,
-        )
-        self.homie_publish_property(
-            node_id="api",
-            property_id="apicount",
-            datatype="integer",
-            value=self.api_count,
-        )
-        self.homie_publish_property(
-            node_id="api",
-            property_id="apilimit",
-            datatype="integer",
-            value=self.api_limit,
+    def quota_reset(self):
+        """Start the new day's count without asking the API."""
+        if self.quota.roll():
+            self.quota_changed()
+            if not self.refreshing:
+                self.schedule_api_refresh()
+
+    def set_areas(self, areas):
+        """Serve areas from now on, see Shard."""
+        acquired = [a for a in areas if a not in self.areas]
+        released = [a for a in self.areas if a not in areas]
+        self.areas = areas
+        for area in released:
+            self.scheduler.cancel("status_refresh/{}".format(area.area_id))
+        if not acquired:
+            return
+        for area in acquired:
+            area.homie_init(self.brokers)
+            if area.last_api_update != None:
+                area.status_refresh()
+        if self.quota.known():
+            self.update_next_api_update()
+        if not self.refreshing:
+            self.schedule_api_refresh()
+        self.scheduler.schedule("homie_publish_all", 0, self.homie_publish_all)
+
+    def homie_init(self, broker=None):
+        """Publish the device trees to broker, or daily to every broker."""
+        if broker == None:
+            brokers = self.brokers
+            self.scheduler.schedule("homie_init", HOMIE_INIT_SECONDS, self.homie_init)
+        else:
+            brokers = [broker]
+        for area in self.areas:
+            area.homie_init(brokers)
+        self.scheduler.schedule("homie_publish_all", 0, self.homie_publish_all)
+
+    def homie_publish_stats(self):
+        """Summary of the metrics as Homie $stats of every device."""
+        stats = [
+            ("interval", HOMIE_STATS_SECONDS),
+            ("uptime", int(self.clock.monotonic() - self.started)),
+            ("publishes", int(metrics.MQTT_PUBLISHES.total())),
+            ("inflight", metrics.MQTT_INFLIGHT.total()),
+            ("apierrors", int(metrics.API_ERRORS.total())),
+            ("apilatency", round(metrics.API_REQUEST_SECONDS.mean(), 3)),
+            ("schedulerlag", round(metrics.SCHEDULER_LAG_SECONDS.mean(), 3)),
+        ]
+        for area in self.areas:
+            for name, value in stats:
+                topic = "{}/{}/{}/{}".format(
+                    HOMIE_BASE_TOPIC, area.device_id, "$stats", name
+                )
+                self.homie_publish(topic, value)
+        self.scheduler.schedule(
+            "homie_publish_stats", HOMIE_STATS_SECONDS, self.homie_publish_stats
         )
-        self.homie_publish_property(
-            node_id="api",
-            property_id="apilimittype",
-            datatype="string",
-            value=self.api_limit_type,
+
+    def homie_publish_all(self):
+        for area in self.areas:
+            area.homie_publish_all()
+        self.scheduler.schedule(
+            "homie_publish_all", HOMIE_PUBLISH_ALL_SECONDS, self.homie_publish_all
         )
 
     def seconds_until_end_of_day(self, dt):
@@ -543,105 +388,417 @@ class ESP:
             timezone(TIMEZONE).localize(datetime.combine(tomorrow, time.min)) - dt
         ).total_seconds()
 
+    def last_api_update(self):
+        """Most recent area fetch across all areas."""
+        updates = [a.last_api_update for a in self.areas if a.last_api_update != None]
+        if updates:
+            return max(updates)
+        return None
+
+    def next_area_to_refresh(self):
+        """
+        Round robin: the area with the oldest data, never fetched first.
+
+        With ESP_LOCAL_SCHEDULE areas are only fetched when their cached
+        timetable runs out.  Otherwise None is returned and the single
+        status call refreshes every area.
+        """
+        for area in self.areas:
+            if area.last_api_update == None:
+                return area
+        if ESP_LOCAL_SCHEDULE:
+            now = self.clock.now(timezone(TIMEZONE))
+            expired = [
+                a
+                for a in self.areas
+                if a.timetable == None or a.timetable.expires() <= now
+            ]
+            if expired:
+                area = min(expired, key=lambda a: a.last_area_fetch)
+                # take turns with the status call, which updates
+                # last_api_update of every area but not last_area_fetch
+                if (
+                    self.status_update == None
+                    or area.last_area_fetch < self.status_update
+                ):
+                    return area
+            return None
+        return min(self.areas, key=lambda a: a.last_api_update)
+
     def update_next_api_update(self):
-        remaining = self.api_limit - self.api_count
-        if self.last_api_update != None:
-            t = self.seconds_until_end_of_day(self.last_api_update)
-            self.next_api_update = self.last_api_update + timedelta(
-                seconds=t / (remaining + 1)
+        """
+        Plan the next call with the remaining calls for the day.
+
+        Each call refreshes one area in turn so the quota is shared evenly.
+        Areas that have never been fetched are fetched straight away while
+        the quota allows.
+        """
+        remaining = self.quota.remaining()
+        if self.shard != None:
+            remaining = self.shard.share(remaining)
+        unfetched = len([a for a in self.areas if a.last_api_update == None])
+        if unfetched > 0 and remaining > ESP_API_RESERVE:
+            self.next_api_update = self.clock.now(timezone(TIMEZONE))
+            return
+        last_api_update = self.last_api_update()
+        if last_api_update != None:
+            reset = self.quota.reset
+            if reset == None:
+                now = self.clock.now(timezone(TIMEZONE))
+                reset = now + timedelta(seconds=self.seconds_until_end_of_day(now))
+            self.next_api_update = self.planner.next_update(
+                last_api_update, reset, remaining, self.planner_hints()
             )
 
-    def get_request(self, url, data={}):
+    def planner_hints(self):
+        now = self.clock.now(timezone(TIMEZONE))
+        starts = set()
+        for area in self.areas:
+            starts.update(s for s in area.timeline.starts if s > now.timestamp())
+        return Hints(
+            event_starts=[to_datetime(s) for s in sorted(starts)],
+            schedule_changed=self.schedule_changed,
+            failed=self.failed_update,
+        )
+
+    def get_request(self, url, data={}, keys=()):
         logger.debug("get_request: {} ".format(url))
-        headers = {"token": ESP_API_TOKEN}
-        try:
-            response = requests.request("GET", url, headers=headers, data=data)
-            r = response.json()
-        except:
-            logger.error("Problem with get request to {}".format(url))
-            r = None
-        return r
+        return self.fetcher.get(url, data=data, keys=keys)
+
+    def fetch_status(self):
+        logger.debug("Get status...")
+        url = ESP_API_URL + "status"
+        return self.get_request(url=url, keys=("status",))
+
+    def load_status(self, r):
+        """Apply the national stage to every cached area timetable."""
+        self.status_response = r
+        for area in self.areas:
+            area.apply_status(r)
 
-    def get_api(self):
+    def fetch_api(self):
         logger.debug("Get api_allowance...")
         url = ESP_API_URL + "api_allowance"
-        r = self.get_request(url=url)
-        if r != None:
-            self.api_count = r["allowance"]["count"]
-            self.api_limit = r["allowance"]["limit"]
-            self.api_limit_type = r["allowance"]["type"]
-            self.update_next_api_update()
-            self.esp_api_counts_refresh_time = datetime.now(timezone(TIMEZONE))
-
-    def get_area(self):
-        self.get_api()
-        if self.api_limit != None and self.api_count != None:
-            if self.api_limit - self.api_count > 0:
-                logger.debug("Get area...")
-                if ESP_TEST:
-                    test = "&test=future"
-                else:
-                    test = ""
-                url = ESP_API_URL + "area" + "?id=" + ESP_AREA_ID + test
-                r = self.get_request(url=url)
-                if r != None:
-                    self.area_name = r["info"]["name"]
-                    self.region_name = r["info"]["region"]
-                    self.events = []
-                    for event in r["events"]:
-                        event["start_string"] = event["start"]
-                        event["start"] = datetime.fromisoformat(event["start_string"])
-                        event["end_string"] = event["end"]
-                        event["end"] = datetime.fromisoformat(event["end_string"])
-                        self.events.append(event)
-                    self.last_api_update = datetime.now(timezone(TIMEZONE))
-                self.get_api()
-
-    def update_loadshedding_status(self):
-        now = datetime.now(timezone(TIMEZONE))
-        self.status_loadshedding = False
-        self.status_loadshedding_next_start = FAR_AWAY_DATE
-        self.status_loadshedding_next_end = FAR_AWAY_DATE
-        self.status_loadshedding_end = FAR_AWAY_DATE
-        self.status_note = "Not loadshedding"
-        for event in self.events:
-            if now > event["start"] and now < event["end"]:
-                self.status_loadshedding = True
-                self.status_loadshedding_end = event["end"]
-                self.status_note = event["note"]
-            if event["start"] > now:
-                if self.status_loadshedding_next_start == None:
-                    self.status_loadshedding_next_start = event["start"]
-                elif self.status_loadshedding_next_start > event["start"]:
-                    self.status_loadshedding_next_start = event["start"]
-                if event["end"] > now:
-                    if self.status_loadshedding_next_end == None:
-                        self.status_loadshedding_next_end = event["end"]
-                    elif self.status_loadshedding_next_end > event["end"]:
-                        self.status_loadshedding_next_end = event["end"]
-        self.next_status_time = now + timedelta(minutes=5)
-        if self.status_loadshedding_next_start == None:
-            self.status_warning_5min = False
-            self.status_warning_15min = False
-        else:
-            if self.status_loadshedding_next_start - now < timedelta(minutes=5):
-                self.status_warning_5min = True
-            else:
-                self.status_warning_5min = False
-                self.next_status_time = self.status_loadshedding_next_start - timedelta(
-                    minutes=5
+        return self.get_request(url=url, keys=("allowance",))
+
+    def save_state(self):
+        """Atomically write the last fetched responses and deadlines to the state file."""
+        if self.state_file == None:
+            return
+        state = {
+            "allowance": self.quota.state(),
+            "next_api_update": self.next_api_update.isoformat(),
+            "areas": {},
+        }
+        if self.status_response != None:
+            state["status"] = {
+                "response": self.status_response,
+                "status_update": self.status_update.isoformat(),
+            }
+        for area in self.all_areas:
+            if area.last_api_update != None:
+                state["areas"][area.area_id] = {
+                    "response": area.response(),
+                    "last_api_update": area.last_api_update.isoformat(),
+                    "last_area_fetch": area.last_area_fetch.isoformat(),
+                }
+        directory = os.path.dirname(os.path.abspath(self.state_file))
+        path = None
+        try:
+            fd, path = tempfile.mkstemp(dir=directory, prefix=".esp_state")
+            with os.fdopen(fd, "w") as f:
+                json.dump(state, f)
+                # on disk before it replaces the old state, a power cut must
+                # not leave an empty file
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path, self.state_file)
+            path = None
+            fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        except Exception as e:
+            logger.error("Could not save state to {}: {}".format(self.state_file, e))
+            if path != None and os.path.exists(path):
+                os.remove(path)
+
+    def load_state(self):
+        """Restore state saved by save_state.  Returns True if anything was loaded."""
+        if self.state_file == None or not os.path.exists(self.state_file):
+            return False
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+            self.quota.load_state(state["allowance"])
+            self.next_api_update = datetime.fromisoformat(state["next_api_update"])
+            for area in self.all_areas:
+                if area.area_id in state["areas"]:
+                    saved = state["areas"][area.area_id]
+                    area.load_area(saved["response"])
+                    area.last_api_update = datetime.fromisoformat(
+                        saved["last_api_update"]
+                    )
+                    area.last_area_fetch = datetime.fromisoformat(
+                        saved.get("last_area_fetch", saved["last_api_update"])
+                    )
+            if ESP_LOCAL_SCHEDULE and "status" in state:
+                self.load_status(state["status"]["response"])
+                self.status_update = datetime.fromisoformat(
+                    state["status"]["status_update"]
                 )
-            if self.status_loadshedding_next_start - now < timedelta(minutes=15):
-                self.status_warning_15min = True
+        except Exception as e:
+            logger.error("Could not load state from {}: {}".format(self.state_file, e))
+            return False
+        logger.info("Loaded state from {}.".format(self.state_file))
+        return True
+
+
+class Area:
+    def __init__(self, esp, area_id, device_id):
+        """Intialise an area published as its own Homie device."""
+        self.esp = esp
+        self.device_id = device_id
+        if device_id == HOMIE_DEVICE_ID:
+            name = HOMIE_DEVICE_NAME
+        else:
+            name = "{} {}".format(HOMIE_DEVICE_NAME, area_id)
+        nodes = [AREA_NODE, API_NODE, STATUS_NODE]
+        nodes += [event_node(i) for i in range(1, HOMIE_MAX_EVENTS + 1)]
+        if HOMIE_SCHEDULE_PROPERTY:
+            nodes.append(SCHEDULE_NODE)
+        self.device = Device(device_id, name, nodes)
+        # Home Assistant config, see ESP.__init__
+        self.discovery_messages = []
+
+        # area
+        self.area_id = area_id
+        self.area_name = None
+        self.region_name = None
+
+        # events
+        self.events = []
+        self.timeline = Timeline(self.events)
+        # raw schedule block for save_state, the rest is rebuilt from events
+        self.schedule_response = None
+
+        # stage timetable for ESP_LOCAL_SCHEDULE
+        self.region = region_for_area(area_id)
+        self.timetable = None
+
+        # last update from API, by an area or a status call, and the last
+        # area call alone
+        self.last_api_update = None
+        self.last_area_fetch = None
+
+        # status
+        self.status_loadshedding = None
+        # epoch seconds, see timeline.to_datetime
+        self.status_loadshedding_next_start = FAR_AWAY
+        self.status_loadshedding_next_end = FAR_AWAY
+        self.status_loadshedding_end = FAR_AWAY
+        self.status_warning_5min = None
+        self.status_warning_15min = None
+        self.status_note = None
+
+        # timers
+        self.next_status_time = 0
+        self.next_transition = FAR_AWAY
+
+    def status_refresh(self, transition=None):
+        """
+        Recompute the status and arm the next refresh.  A scheduled refresh
+        passes the transition it was armed for to measure publish jitter.
+        """
+        before = self.status_loadshedding
+        self.update_loadshedding_status()
+        if self.esp.archive != None and self.status_loadshedding != before:
+            self.esp.archive.transition(
+                self.area_id,
+                self.esp.clock.now(timezone(TIMEZONE)).timestamp(),
+                self.status_loadshedding,
+                self.status_note,
+            )
+        self.esp.scheduler.schedule_at(
+            "status_refresh/{}".format(self.area_id),
+            to_datetime(self.next_status_time),
+            partial(self.status_refresh, self.next_transition),
+        )
+        if ESP_PRECISE_TRANSITIONS:
+            # publish the change now, homie_publish_all follows for the rest
+            self.homie_publish_status()
+            if transition != None:
+                now = self.esp.clock.now(timezone(TIMEZONE))
+                jitter = now.timestamp() - transition
+                if jitter >= 0:
+                    metrics.TRANSITION_JITTER_SECONDS.observe(jitter)
+                    logger.debug(
+                        "Published {} transition at {} {:.1f}ms late.".format(
+                            self.area_id, to_datetime(transition), jitter * 1e3
+                        )
+                    )
+        self.esp.scheduler.schedule("homie_publish_all", 0, self.esp.homie_publish_all)
+
+    def homie_publish(self, topic, message):
+        self.esp.homie_publish(topic, message)
+
+    def homie_publish_device_state(self, state):
+        self.homie_publish(self.device.state_topic, state)
+
+    def homie_init(self, brokers):
+        # whole $ tree in one burst, device ready last
+        # Home Assistant entities on the same property topics
+        messages = self.device.init_messages + self.discovery_messages
+        for broker in brokers:
+            for topic, payload in messages:
+                broker.publish(topic, payload)
+            ready = partial(broker.publish, self.device.state_topic, "ready")
+            if HOMIE_READY_AFTER_ACKS:
+                broker.publisher.when_idle(ready)
             else:
-                self.status_warning_15min = False
-                self.next_status_time = self.status_loadshedding_next_start - timedelta(
-                    minutes=5
-                )
-            if self.status_loadshedding_next_start < self.next_status_time:
-                self.next_status_time = self.status_loadshedding_next_start
-        if self.status_loadshedding_end == None:
-            pass
+                ready()
+
+    def homie_publish_all(self):
+        self.homie_publish_area()
+        self.homie_publish_api()
+        self.homie_publish_events()
+        self.homie_publish_status()
+
+    def homie_publish_property(self, node_id, property_id, value=None):
+        if value != None:
+            topic, datatype = self.device.properties[node_id, property_id]
+            message = encode_value(datatype, value)
+            self.esp.homie_publish_changed(topic, message)
+
+    def homie_publish_properties(self, node_id, values):
+        for property_id, value in values:
+            self.homie_publish_property(node_id, property_id, value)
+
+    def homie_publish_status(self):
+        self.homie_publish_properties(
+            "status",
+            [
+                ("loadshedding", self.status_loadshedding),
+                ("warning5min", self.status_warning_5min),
+                ("warning15min", self.status_warning_15min),
+                (
+                    "loadsheddingnextstart",
+                    to_datetime(self.status_loadshedding_next_start),
+                ),
+                (
+                    "loadsheddingnextend",
+                    to_datetime(self.status_loadshedding_next_end),
+                ),
+                ("loadsheddingend", to_datetime(self.status_loadshedding_end)),
+                ("note", self.status_note),
+            ],
+        )
+
+    def homie_publish_area(self):
+        self.homie_publish_properties(
+            "area",
+            [
+                ("areaid", self.area_id),
+                ("areaname", self.area_name),
+                ("regionname", self.region_name),
+            ],
+        )
+
+    def homie_publish_events(self):
+        """
+        Publish the next events as event slots and the whole upcoming
+        schedule as one property.  homie_publish_changed leaves out the
+        values that did not change.
+        """
+        now = self.esp.clock.now(timezone(TIMEZONE))
+        upcoming = self.timeline.upcoming(now.timestamp())
+        slots = [(e.start, e.end, e.note) for e in upcoming[:HOMIE_MAX_EVENTS]]
+        slots += [(None, None, "")] * (HOMIE_MAX_EVENTS - len(slots))
+        for i, slot in enumerate(slots):
+            node_id = "event{}".format(i + 1)
+            start, end, note = slot
+            for property_id, message in [
+                ("start", encode_datetime(to_datetime(start))),
+                ("end", encode_datetime(to_datetime(end))),
+                ("note", note),
+            ]:
+                topic = self.device.properties[node_id, property_id][0]
+                self.esp.homie_publish_changed(topic, message)
+        if HOMIE_SCHEDULE_PROPERTY:
+            schedule = [
+                [
+                    to_datetime(e.start).isoformat(),
+                    to_datetime(e.end).isoformat(),
+                    e.note,
+                ]
+                for e in upcoming
+            ]
+            self.homie_publish_property("schedule", "events", schedule)
+
+    def homie_publish_api(self):
+        self.homie_publish_properties(
+            "api",
+            [
+                ("lastapiupdate", self.last_api_update),
+                ("apicount", self.esp.quota.count),
+                ("apilimit", self.esp.quota.limit),
+                ("apilimittype", self.esp.quota.type),
+            ],
+        )
+
+    def fetch_area(self):
+        """Fetch the area schedule.  Runs on the fetch thread."""
+        logger.debug("Get area {}...".format(self.area_id))
+        if ESP_TEST:
+            test = "&test=future"
         else:
-            if self.status_loadshedding_end < self.next_status_time:
-                self.next_status_time = self.status_loadshedding_end
+            test = ""
+        url = ESP_API_URL + "area" + "?id=" + self.area_id + test
+        return self.esp.get_request(url=url, keys=("info", "events"))
+
+    def load_area(self, r):
+        """Parse an area response once into Event records."""
+        self.area_name = r["info"]["name"]
+        self.region_name = r["info"]["region"]
+        self.events = [Event.parse(event) for event in r["events"]]
+        self.timeline = Timeline(self.events)
+        if "schedule" in r:
+            self.schedule_response = r["schedule"]
+            self.timetable = Timetable(r["schedule"])
+
+    def response(self):
+        """What load_area needs of the last area response, for save_state."""
+        r = {
+            "info": {"name": self.area_name, "region": self.region_name},
+            "events": [event.to_dict() for event in self.events],
+        }
+        if self.schedule_response != None:
+            r["schedule"] = self.schedule_response
+        return r
+
+    def apply_status(self, status):
+        """Derive events from the cached timetable and the region's stages."""
+        if self.timetable == None:
+            return
+        if self.region not in status["status"]:
+            logger.error("No {} region in status response.".format(self.region))
+            return
+        self.events = self.timetable.events(parse_stages(status, self.region))
+        self.timeline = Timeline(self.events)
+
+    def update_loadshedding_status(self):
+        started = perf_counter()
+        now = self.esp.clock.now(timezone(TIMEZONE)).timestamp()
+        status = self.timeline.status(now)
+        self.status_loadshedding = status.loadshedding
+        self.status_loadshedding_next_start = status.next_start
+        self.status_loadshedding_next_end = status.next_end
+        self.status_loadshedding_end = status.end
+        self.status_warning_5min = status.warning_5min
+        self.status_warning_15min = status.warning_15min
+        self.status_note = status.note
+        # recompute at least every 5 minutes
+        self.next_transition = status.next_transition
+        self.next_status_time = min(status.next_transition, now + 5 * 60)
+        metrics.STATUS_UPDATE_SECONDS.observe(perf_counter() - started)
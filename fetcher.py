@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+import logging
+
+logger = logging.getLogger("esp_mqtt").getChild(__name__)
+import random
+from queue import Queue
+from functools import partial
+from threading import Thread
+from time import sleep, monotonic
+from urllib.parse import urlparse
+
+from config_defaults import *
+from config import *
+import metrics
+from cassette import make_transport
+
+import requests
+
+
+class Fetcher:
+    def __init__(self, scheduler):
+        """Run ESP API requests on a background thread.
+
+        Work is a function run on the fetch thread.  Its result is handed to
+        the callback on the scheduler thread so state is only ever changed
+        there and publishing never waits on the network.
+        """
+        self.scheduler = scheduler
+        self.session = requests.Session()
+        self.session.headers.update({"token": ESP_API_TOKEN})
+        self.transport = make_transport(self.session)
+        self.queue = Queue()
+        self.thread = Thread(target=self.run, name="esp_fetch", daemon=True)
+        self.thread.start()
+
+    def submit(self, work, callback):
+        self.queue.put((work, callback))
+
+    def run(self):
+        while True:
+            work, callback = self.queue.get()
+            try:
+                result = work()
+            except Exception as e:
+                logger.exception("Fetch failed: {}".format(e))
+                result = None
+            self.scheduler.call_soon(partial(callback, result))
+
+    def backoff(self, attempt):
+        """Full jitter exponential backoff."""
+        cap = min(ESP_API_BACKOFF_MAX_SECONDS, ESP_API_BACKOFF_SECONDS * 2**attempt)
+        return random.uniform(0, cap)
+
+    def get(self, url, data={}, keys=()):
+        """GET url and return the decoded json or None.
+
+        Connection problems, timeouts and server errors are retried.  Other
+        error statuses and a body without each of keys are failures.
+        """
+        endpoint = urlparse(url).path.rsplit("/", 1)[-1]
+        for attempt in range(ESP_API_RETRIES + 1):
+            if attempt > 0:
+                sleep(self.backoff(attempt))
+            start = monotonic()
+            try:
+                response = self.transport.get(
+                    url,
+                    data=data,
+                    timeout=(ESP_API_CONNECT_TIMEOUT, ESP_API_READ_TIMEOUT),
+                )
+            except requests.RequestException as e:
+                metrics.API_REQUEST_SECONDS.observe(monotonic() - start, endpoint)
+                metrics.API_ERRORS.inc(endpoint)
+                logger.warning("{} for get request to {}".format(e, url))
+                continue
+            metrics.API_REQUEST_SECONDS.observe(monotonic() - start, endpoint)
+            if response.status_code >= 500:
+                metrics.API_ERRORS.inc(endpoint)
+                logger.warning(
+                    "Status {} for get request to {}".format(response.status_code, url)
+                )
+                continue
+            if not 200 <= response.status_code < 300:
+                metrics.API_ERRORS.inc(endpoint)
+                logger.error(
+                    "Status {} for get request to {}: {}".format(
+                        response.status_code, url, response.text[:200]
+                    )
+                )
+                return None
+            try:
+                body = response.json()
+            except ValueError:
+                metrics.API_ERRORS.inc(endpoint)
+                break
+            if not isinstance(body, dict) or any(k not in body for k in keys):
+                metrics.API_ERRORS.inc(endpoint)
+                logger.error("Unexpected response to {}: {}".format(url, body))
+                return None
+            return body
+        logger.error("Problem with get request to {}".format(url))
+        return None
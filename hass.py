@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+import logging
+
+logger = logging.getLogger("esp_mqtt").getChild(__name__)
+import json
+
+from config_defaults import *
+from config import *
+
+# Homie datatype -> (Home Assistant component, extra config)
+COMPONENTS = {
+    "boolean": ("binary_sensor", {"payload_on": "true", "payload_off": "false"}),
+    "datetime": (
+        "sensor",
+        {"device_class": "timestamp", "value_template": "{{ value or None }}"},
+    ),
+    "integer": ("sensor", {"state_class": "measurement"}),
+    "string": ("sensor", {}),
+    # the state is the number of items, the items are attributes
+    "json": (
+        "sensor",
+        {
+            "value_template": "{{ value_json | count }}",
+            "json_attributes_template": '{"items": {{ value }} }',
+        },
+    ),
+}
+
+
+def discovery_messages(device, will_topic):
+    """
+    Home Assistant MQTT discovery config for every property of a Homie
+    device.  Entities read the Homie property topics directly so a value
+    is published once for both.  They are available while both the device
+    $state and will_topic, the $state that goes lost with the connection,
+    are ready.  Settable properties become buttons.
+    """
+    ha_device = {
+        "identifiers": [device.device_id],
+        "name": device.name,
+        "model": HOMIE_IMPLEMENTATION,
+    }
+    availability = [
+        {"topic": topic, "payload_available": "ready", "payload_not_available": "lost"}
+        for topic in dict.fromkeys([device.state_topic, will_topic])
+    ]
+    messages = []
+    for node in device.nodes:
+        for p in node.properties:
+            component, extra = COMPONENTS[p.datatype]
+            property_topic = device.properties[node.node_id, p.property_id][0]
+            if p.settable:
+                # commands, see commands.py
+                component = "button"
+                extra = {
+                    "command_topic": property_topic + "/set",
+                    "payload_press": "true",
+                }
+            object_id = "{}_{}_{}".format(device.device_id, node.node_id, p.property_id)
+            config = {
+                "name": p.name,
+                "unique_id": object_id,
+                "object_id": object_id,
+                "availability": availability,
+                "availability_mode": "all",
+                "device": ha_device,
+            }
+            if not p.settable:
+                config["state_topic"] = property_topic
+            if p.unit != None:
+                config["unit_of_measurement"] = p.unit
+            config.update(extra)
+            if "json_attributes_template" in config:
+                config["json_attributes_topic"] = config["state_topic"]
+            topic = "{}/{}/{}/{}_{}/config".format(
+                HASS_DISCOVERY_PREFIX,
+                component,
+                device.device_id,
+                node.node_id,
+                p.property_id,
+            )
+            messages.append((topic, json.dumps(config).encode()))
+    return messages
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+import logging
+
+logger = logging.getLogger("esp_mqtt").getChild(__name__)
+import json
+
+from config_defaults import *
+from config import *
+
+
+class Property:
+    def __init__(
+        self,
+        property_id,
+        name,
+        datatype,
+        format=None,
+        settable=False,
+        retained=True,
+        unit=None,
+    ):
+        """A Homie property.  datetime and json are published as strings."""
+        self.property_id = property_id
+        self.name = name
+        self.datatype = datatype
+        self.format = format
+        self.settable = settable
+        self.retained = retained
+        self.unit = unit
+
+    def attributes(self):
+        if self.datatype in ("datetime", "json"):
+            datatype = "string"
+        else:
+            datatype = self.datatype
+        attributes = [("$name", self.name), ("$datatype", datatype)]
+        if self.format != None:
+            attributes.append(("$format", self.format))
+        attributes.append(("$settable", encode_boolean(self.settable)))
+        attributes.append(("$retained", encode_boolean(self.retained)))
+        if self.unit != None:
+            attributes.append(("$unit", self.unit))
+        return attributes
+
+
+class Node:
+    def __init__(self, node_id, name, properties, type=None):
+        self.node_id = node_id
+        self.name = name
+        self.properties = properties
+        self.type = type
+
+    def attributes(self):
+        attributes = [("$name", self.name)]
+        if self.type != None:
+            attributes.append(("$type", self.type))
+        properties = ",".join(p.property_id for p in self.properties)
+        attributes.append(("$properties", properties))
+        return attributes
+
+
+AREA_NODE = Node(
+    "area",
+    "Area",
+    [
+        Property("areaid", "Area ID", "string"),
+        Property("areaname", "Area Name", "string"),
+        Property("regionname", "Region Name", "string"),
+    ],
+)
+
+API_NODE = Node(
+    "api",
+    "API",
+    [
+        Property("lastapiupdate", "Last Update", "datetime"),
+        Property("apicount", "API Count", "integer"),
+        Property("apilimit", "API Limit", "integer"),
+        Property("apilimittype", "API Limit Type", "string"),
+        Property("refresh", "Refresh", "boolean", settable=True, retained=False),
+    ],
+)
+
+STATUS_NODE = Node(
+    "status",
+    "Loadshedding status",
+    [
+        Property("loadshedding", "Current Loadshedding", "boolean"),
+        Property("warning15min", "Loadshedding 15 minute Warning", "boolean"),
+        Property("warning5min", "Loadshedding 5 minute Warning", "boolean"),
+        Property("loadsheddingnextstart", "Loadshedding Start Time", "datetime"),
+        Property("loadsheddingnextend", "Loadshedding End Time", "datetime"),
+        Property("loadsheddingend", "Loadshedding End Time", "datetime"),
+        Property("note", "Status Note", "string"),
+        Property("republish", "Republish", "boolean", settable=True, retained=False),
+    ],
+)
+
+
+def event_node(i):
+    return Node(
+        "event{}".format(i),
+        "Event {}".format(i),
+        [
+            Property("start", "Start Time", "datetime"),
+            Property("end", "End Time", "datetime"),
+            Property("note", "Note", "string"),
+        ],
+    )
+
+
+SCHEDULE_NODE = Node(
+    "schedule",
+    "Schedule",
+    [Property("events", "Upcoming Events", "json")],
+)
+
+
+def encode_boolean(value):
+    if value:
+        return "true"
+    else:
+        return "false"
+
+
+def encode_datetime(value):
+    if value == None:
+        return ""
+    else:
+        return value.isoformat()
+
+
+def encode_value(datatype, value):
+    if datatype == "boolean":
+        return encode_boolean(value)
+    elif datatype == "datetime":
+        return encode_datetime(value)
+    elif datatype == "json":
+        return json.dumps(value, separators=(",", ":"))
+    else:
+        return value
+
+
+def encode_payload(message):
+    """Bytes of a message, encoded once and handed to every broker."""
+    if isinstance(message, bytes):
+        return message
+    return str(message).encode("utf-8")
+
+
+class Device:
+    def __init__(self, device_id, name, nodes):
+        """
+        Compile a Homie device once: every topic string and the encoded
+        payloads of the whole `$` attribute tree.
+        """
+        self.device_id = device_id
+        self.name = name
+        self.nodes = nodes
+        base = "{}/{}".format(HOMIE_BASE_TOPIC, device_id)
+        self.base_topic = base
+        self.state_topic = "{}/{}".format(base, "$state")
+
+        # (node_id, property_id) -> (topic, datatype)
+        self.properties = {}
+
+        # whole init burst in publish order
+        self.init_messages = [
+            ("{}/{}".format(base, "$homie"), HOMIE_DEVICE_VERSION.encode()),
+            ("{}/{}".format(base, "$name"), name.encode()),
+            (self.state_topic, b"init"),
+            (
+                "{}/{}".format(base, "$nodes"),
+                ",".join(n.node_id for n in nodes).encode(),
+            ),
+            ("{}/{}".format(base, "$extensions"), HOMIE_DEVICE_EXTENSIONS.encode()),
+            ("{}/{}".format(base, "$implementation"), HOMIE_IMPLEMENTATION.encode()),
+        ]
+        for node in nodes:
+            node_topic = "{}/{}".format(base, node.node_id)
+            for attribute, value in node.attributes():
+                topic = "{}/{}".format(node_topic, attribute)
+                self.init_messages.append((topic, value.encode()))
+            for p in node.properties:
+                property_topic = "{}/{}".format(node_topic, p.property_id)
+                self.properties[node.node_id, p.property_id] = (
+                    property_topic,
+                    p.datatype,
+                )
+                for attribute, value in p.attributes():
+                    topic = "{}/{}".format(property_topic, attribute)
+                    self.init_messages.append((topic, value.encode()))
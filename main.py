@@ -1,5 +1,7 @@
 #!/usr/bin/env python
+import argparse
 import logging
+from datetime import datetime
 from config_defaults import *
 from config import *
 
@@ -23,8 +25,47 @@ ch.setLevel(LOGGING_LEVEL_CONSOLE)
 ch.setFormatter(formatter)
 logger.addHandler(ch)
 
-import esp
+parser = argparse.ArgumentParser(
+    description="Publish EskomSePush loadshedding status to MQTT."
+)
+parser.add_argument(
+    "--replay",
+    nargs="+",
+    metavar="RESPONSE",
+    help="replay recorded area (or status) responses on a simulated clock",
+)
+parser.add_argument(
+    "--output", default="-", help="replay output, a JSON line per publish"
+)
+parser.add_argument(
+    "--start", help="replay start (ISO 8601), midnight before the first event"
+)
+parser.add_argument(
+    "--hours", type=float, default=24 * 7, help="simulated hours to replay"
+)
+args = parser.parse_args()
 
-esp = esp.ESP()
+if args.replay:
+    import sys
+    import replay
+    from pytz import timezone
 
-esp.main_loop()
+    start = None
+    if args.start != None:
+        start = datetime.fromisoformat(args.start)
+        if start.tzinfo == None:
+            start = timezone(TIMEZONE).localize(start)
+    if args.output == "-":
+        replay.replay(args.replay, sys.stdout, start, args.hours)
+    else:
+        with open(args.output, "w") as output:
+            replay.replay(args.replay, output, start, args.hours)
+else:
+    import esp
+    import metrics
+
+    metrics.start_server()
+
+    esp = esp.ESP()
+
+    esp.main_loop()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+import logging
+
+logger = logging.getLogger("esp_mqtt").getChild(__name__)
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+from config_defaults import *
+from config import *
+
+DEFAULT_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+registry = []
+
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra != None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, v) for k, v in pairs) + "}"
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = Lock()
+        registry.append(self)
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} {}".format(self.name, self.type),
+        ]
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.extend(self.render_value(label_values, value))
+        return lines
+
+    def render_value(self, label_values, value):
+        return [
+            "{}{} {}".format(self.name, format_labels(self.labels, label_values), value)
+        ]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def total(self):
+        with self.lock:
+            return sum(self.values.values())
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, *label_values):
+        with self.lock:
+            self.values[label_values] = value
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        with self.lock:
+            return self.values.get(label_values, 0)
+
+    def total(self):
+        with self.lock:
+            return sum(self.values.values())
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            if label_values not in self.values:
+                self.values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            counts, total, count = self.values[label_values]
+            i = bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                counts[i] += 1
+            self.values[label_values] = [counts, total + value, count + 1]
+
+    def mean(self):
+        """Mean over all label values, for a quick summary."""
+        with self.lock:
+            total = sum(v[1] for v in self.values.values())
+            count = sum(v[2] for v in self.values.values())
+        if count == 0:
+            return 0
+        return total / count
+
+    def render_value(self, label_values, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bucket, n in zip(self.buckets, counts):
+            cumulative += n
+            labels = format_labels(self.labels, label_values, ("le", bucket))
+            lines.append("{}_bucket{} {}".format(self.name, labels, cumulative))
+        labels = format_labels(self.labels, label_values, ("le", "+Inf"))
+        lines.append("{}_bucket{} {}".format(self.name, labels, count))
+        labels = format_labels(self.labels, label_values)
+        lines.append("{}_sum{} {}".format(self.name, labels, total))
+        lines.append("{}_count{} {}".format(self.name, labels, count))
+        return lines
+
+
+def render():
+    """All metrics in the Prometheus text format."""
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+API_REQUEST_SECONDS = Histogram(
+    "esp_api_request_seconds", "ESP API request latency.", ["endpoint"]
+)
+API_ERRORS = Counter("esp_api_errors_total", "Failed ESP API requests.", ["endpoint"])
+API_COUNT = Gauge("esp_api_count", "ESP API calls used in the current period.")
+API_LIMIT = Gauge("esp_api_limit", "ESP API calls allowed per period.")
+API_REMAINING = Gauge("esp_api_remaining", "ESP API calls remaining this period.")
+MQTT_PUBLISHES = Counter(
+    "esp_mqtt_publishes_total", "MQTT messages published.", ["broker", "topic_class"]
+)
+MQTT_INFLIGHT = Gauge(
+    "esp_mqtt_inflight", "MQTT publishes waiting to be acknowledged.", ["broker"]
+)
+MQTT_QUEUED = Gauge(
+    "esp_mqtt_queued", "MQTT publishes waiting for the window.", ["broker"]
+)
+MQTT_COALESCED = Counter(
+    "esp_mqtt_coalesced_total",
+    "Queued MQTT publishes replaced by a newer value.",
+    ["broker"],
+)
+MQTT_DROPPED = Counter(
+    "esp_mqtt_dropped_total",
+    "Queued MQTT publishes dropped because the queue was full.",
+    ["broker"],
+)
+MQTT_PUBACK_SECONDS = Histogram(
+    "esp_mqtt_puback_seconds",
+    "Time from publish to broker acknowledgement.",
+    ["broker"],
+)
+COMMANDS = Counter(
+    "esp_commands_total", "Commands set over MQTT by result.", ["command", "result"]
+)
+SCHEDULER_LAG_SECONDS = Histogram(
+    "esp_scheduler_lag_seconds", "How late scheduled jobs ran.", ["job"]
+)
+CLOCK_STEPS = Counter(
+    "esp_clock_steps_total", "Wall clock steps that moved scheduled jobs."
+)
+TRANSITION_JITTER_SECONDS = Histogram(
+    "esp_transition_jitter_seconds",
+    "Delay from a status transition instant to its publish.",
+    buckets=[0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1, 5],
+)
+STATUS_UPDATE_SECONDS = Histogram(
+    "esp_status_update_seconds",
+    "Time spent in update_loadshedding_status.",
+    buckets=[0.00001, 0.0001, 0.001, 0.01, 0.1],
+)
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        data = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(port=None, host=None):
+    """Serve /metrics on a background thread.  Does nothing without a port."""
+    if port == None:
+        port = METRICS_PORT
+    if host == None:
+        host = METRICS_HOST
+    if port == None:
+        return None
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, name="esp_metrics", daemon=True).start()
+    logger.info("Serving metrics on {}:{}".format(host, server.server_port))
+    return server
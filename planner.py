@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+import logging
+
+logger = logging.getLogger("esp_mqtt").getChild(__name__)
+from bisect import bisect_left
+from collections import namedtuple
+from datetime import datetime, timedelta, time
+
+from config_defaults import *
+from config import *
+from pytz import timezone
+
+# What the planner knows about the schedule.  event_starts is sorted.
+Hints = namedtuple("Hints", ["event_starts", "schedule_changed", "failed"])
+NO_HINTS = Hints(event_starts=[], schedule_changed=None, failed=None)
+
+STEP = timedelta(seconds=60)
+
+
+def make_planner(name=None):
+    if name == None:
+        name = ESP_PLANNER
+    if name == "even":
+        return EvenPlanner()
+    if name == "adaptive":
+        return AdaptivePlanner()
+    raise ValueError("Unknown ESP_PLANNER {}".format(name))
+
+
+class EvenPlanner:
+    """Spread the remaining calls evenly over the time until the quota resets."""
+
+    def next_update(self, last_update, reset, remaining, hints=NO_HINTS):
+        """
+        Time of the next call given the last one, the quota reset time and
+        the calls remaining before it.
+        """
+        available = remaining - ESP_API_RESERVE
+        if available <= 0:
+            return reset
+        t = (reset - last_update).total_seconds()
+        return last_update + timedelta(seconds=t / (available + 1))
+
+
+class AdaptivePlanner(EvenPlanner):
+    """
+    Spread the remaining calls so that each covers an equal share of value.
+
+    Value per minute is ESP_PLANNER_HOUR_WEIGHTS for the hour, multiplied
+    before a scheduled start, after the schedule changed and after a
+    failed fetch.  With flat weights this is the even planner.
+    """
+
+    def weight(self, t, hints):
+        w = ESP_PLANNER_HOUR_WEIGHTS[t.hour]
+        i = bisect_left(hints.event_starts, t)
+        if i < len(hints.event_starts):
+            until_start = (hints.event_starts[i] - t).total_seconds()
+            if until_start <= ESP_PLANNER_EVENT_SECONDS:
+                w *= ESP_PLANNER_EVENT_WEIGHT
+        if hints.schedule_changed != None:
+            since_change = (t - hints.schedule_changed).total_seconds()
+            if 0 <= since_change <= ESP_PLANNER_CHANGE_SECONDS:
+                w *= ESP_PLANNER_CHANGE_WEIGHT
+        if hints.failed != None:
+            since_failure = (t - hints.failed).total_seconds()
+            if 0 <= since_failure <= ESP_PLANNER_CHANGE_SECONDS:
+                w *= ESP_PLANNER_FAILED_WEIGHT
+        return w
+
+    def next_update(self, last_update, reset, remaining, hints=NO_HINTS):
+        available = remaining - ESP_API_RESERVE
+        if available <= 0 or last_update >= reset:
+            return reset
+        weights = []
+        t = last_update
+        while t < reset:
+            weights.append(self.weight(t, hints))
+            t += STEP
+        if sum(weights) == 0:
+            # nothing worth a call before the reset
+            return reset
+        share = sum(weights) / (available + 1)
+        total = 0
+        for i, w in enumerate(weights):
+            if total + w >= share:
+                return last_update + STEP * (i + (share - total) / w)
+            total += w
+        return reset
+
+
+def simulate(planner, start, limit, hints=NO_HINTS):
+    """Times the planner would call the API from start until the quota resets."""
+    tz = timezone(TIMEZONE)
+    reset = tz.localize(datetime.combine(start + timedelta(days=1), time.min))
+    calls = []
+    last_update = start
+    remaining = limit
+    while remaining > ESP_API_RESERVE:
+        t = planner.next_update(last_update, reset, remaining, hints)
+        if t >= reset:
+            break
+        calls.append(t)
+        last_update = t
+        remaining -= 1
+    return calls
+
+
+if __name__ == "__main__":
+    tz = timezone(TIMEZONE)
+    start = tz.localize(datetime.combine(datetime.now(tz).date(), time.min))
+    hints = Hints(
+        event_starts=[start + timedelta(hours=h) for h in (6, 14, 22)],
+        schedule_changed=None,
+        failed=None,
+    )
+    for name in ("even", "adaptive"):
+        calls = simulate(make_planner(name), start, 50, hints)
+        print("{}: {} calls".format(name, len(calls)))
+        print(" ".join(c.strftime("%H:%M") for c in calls))
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+import logging
+
+logger = logging.getLogger("esp_mqtt").getChild(__name__)
+from collections import OrderedDict, deque
+from itertools import count
+from time import perf_counter
+
+from config_defaults import *
+from config import *
+import metrics
+
+import paho.mqtt.client as mqtt
+
+
+def topic_class(topic):
+    """Coarse kind of topic for the publish metrics."""
+    if topic.endswith("/$state"):
+        return "state"
+    if topic.startswith(HASS_DISCOVERY_PREFIX + "/"):
+        return "discovery"
+    if "/$stats/" in topic:
+        return "stats"
+    if "/$" in topic:
+        return "attribute"
+    return "property"
+
+
+# topic classes that may be dropped, publish_changed sends them again
+VALUES = ("property", "stats")
+
+
+class Publisher:
+    def __init__(self, client, scheduler, name="default"):
+        """Windowed MQTT publisher in front of the paho client.
+
+        At most MQTT_MAX_INFLIGHT messages are handed to paho before they are
+        acknowledged, the rest wait in a queue.  A queued retained message
+        is replaced by a newer one for the same topic.  Property values wait
+        behind the $ tree, attributes and discovery config, in a queue of at
+        most MQTT_MAX_QUEUED where the oldest is dropped when it is full.
+        The others are never dropped, there are only so many topics of them.
+
+        Only used from the scheduler thread.  Acknowledgements arrive on the
+        network thread and are handed over with call_soon, so no lock is
+        held while paho runs on_publish under its own mutex.
+        """
+        self.client = client
+        self.scheduler = scheduler
+        self.name = name
+        self.client.max_inflight_messages_set(MQTT_MAX_INFLIGHT)
+        self.client.on_publish = self.on_publish
+        # key is the topic for retained messages so newer values replace older
+        self.queue = OrderedDict()
+        self.values = OrderedDict()
+        self.counter = count()
+        # publish time by mid until acknowledged
+        self.inflight = {}
+        self.acks = deque()
+        self.idle_callbacks = []
+        self.on_drop = None
+
+    def publish(self, topic, payload, qos=HOMIE_MQTT_QOS, retain=HOMIE_MQTT_RETAIN):
+        key = topic if retain else (topic, next(self.counter))
+        queue = self.values if topic_class(topic) in VALUES else self.queue
+        if key in queue:
+            metrics.MQTT_COALESCED.inc(self.name)
+            del queue[key]
+        elif queue is self.values and len(queue) >= MQTT_MAX_QUEUED:
+            _, (dropped, _, _, _) = queue.popitem(last=False)
+            metrics.MQTT_DROPPED.inc(self.name)
+            logger.warning("MQTT {} queue full, dropped {}.".format(self.name, dropped))
+            if self.on_drop != None:
+                self.on_drop(dropped)
+        queue[key] = (topic, payload, qos, retain)
+        self.pump()
+
+    def pump(self):
+        """Hand queued messages to paho while the window has room."""
+        while (
+            (self.queue or self.values)
+            and len(self.inflight) < MQTT_MAX_INFLIGHT
+            and self.client.is_connected()
+        ):
+            queue = self.queue if self.queue else self.values
+            key, (topic, payload, qos, retain) = queue.popitem(last=False)
+            sent = perf_counter()
+            info = self.client.publish(topic, payload, qos=qos, retain=retain)
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                # not taken by paho, keep it unless already superseded
+                if key not in queue:
+                    queue[key] = (topic, payload, qos, retain)
+                    queue.move_to_end(key, last=False)
+                break
+            metrics.MQTT_PUBLISHES.inc(self.name, topic_class(topic))
+            self.inflight[info.mid] = sent
+        self.update_gauges()
+        self.check_idle()
+
+    def on_publish(self, client, userdata, mid):
+        self.acks.append((mid, perf_counter()))
+        self.scheduler.call_soon(self.acknowledged)
+
+    def queued(self):
+        return len(self.queue) + len(self.values)
+
+    def acknowledged(self):
+        while self.acks:
+            mid, acked = self.acks.popleft()
+            sent = self.inflight.pop(mid, None)
+            if sent != None:
+                metrics.MQTT_PUBACK_SECONDS.observe(acked - sent, self.name)
+        self.pump()
+
+    def connected(self):
+        self.pump()
+
+    def disconnected(self):
+        # pending callbacks belong to the lost session, homie_init follows
+        self.idle_callbacks = []
+
+    def when_idle(self, callback):
+        """Run callback once everything queued so far is acknowledged."""
+        self.idle_callbacks.append(callback)
+        self.check_idle()
+
+    def check_idle(self):
+        if self.idle_callbacks and not self.queued() and not self.inflight:
+            callbacks = self.idle_callbacks
+            self.idle_callbacks = []
+            for callback in callbacks:
+                callback()
+
+    def update_gauges(self):
+        metrics.MQTT_INFLIGHT.set(len(self.inflight), self.name)
+        metrics.MQTT_QUEUED.set(self.queued(), self.name)
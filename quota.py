@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+import logging
+
+logger = logging.getLogger("esp_mqtt").getChild(__name__)
+from datetime import datetime, timedelta, time
+
+from config_defaults import *
+from config import *
+from pytz import timezone
+
+
+def next_reset(dt):
+    """Midnight after dt, when a daily allowance starts again."""
+    tz = timezone(TIMEZONE)
+    return tz.localize(datetime.combine(dt.astimezone(tz).date(), time.min)) + (
+        timedelta(days=1)
+    )
+
+
+class QuotaLedger:
+    def __init__(self, clock, reconcile_seconds=ESP_API_RECONCILE_SECONDS):
+        """
+        Local count of the billable API calls (area and status) made in the
+        current period, so api_allowance is only asked now and then.
+
+        reconcile_due is True until the allowance has been fetched once,
+        after reconcile_seconds, after a billable call failed (it may or may
+        not have been counted) and after the daily reset.
+        """
+        self.clock = clock
+        self.reconcile_seconds = reconcile_seconds
+        self.count = None
+        self.limit = None
+        self.type = None
+        # start of the next period and the last api_allowance answer
+        self.reset = None
+        self.reconciled = None
+        self.suspect = True
+
+    def known(self):
+        return self.limit != None
+
+    def remaining(self):
+        return self.limit - self.count
+
+    def reconcile_due(self):
+        if not self.known() or self.suspect or self.reconciled == None:
+            return True
+        age = (self.clock.now(timezone(TIMEZONE)) - self.reconciled).total_seconds()
+        return age >= self.reconcile_seconds
+
+    def reconcile(self, allowance):
+        """Take the count from an api_allowance response."""
+        count = allowance["allowance"]["count"]
+        if self.count != None and not self.suspect and count != self.count:
+            logger.info(
+                "API count was {} but the allowance says {}.".format(self.count, count)
+            )
+        now = self.clock.now(timezone(TIMEZONE))
+        self.count = count
+        self.limit = allowance["allowance"]["limit"]
+        self.type = allowance["allowance"]["type"]
+        self.reset = next_reset(now) if self.type == "daily" else None
+        self.reconciled = now
+        self.suspect = False
+
+    def charge(self):
+        """Count a billable call that succeeded."""
+        if self.known():
+            self.count += 1
+
+    def failed(self):
+        """A billable call may have been counted, ask the allowance next time."""
+        self.suspect = True
+
+    def roll(self):
+        """Start a new period if the reset has passed.  Returns True if it did."""
+        now = self.clock.now(timezone(TIMEZONE))
+        if self.reset == None or now < self.reset:
+            return False
+        self.count = 0
+        self.reset = next_reset(now)
+        # the API may not reset on exactly the same second
+        self.suspect = True
+        return True
+
+    def state(self):
+        return {
+            "count": self.count,
+            "limit": self.limit,
+            "type": self.type,
+            "reset": None if self.reset == None else self.reset.isoformat(),
+            "reconciled": (
+                None if self.reconciled == None else self.reconciled.isoformat()
+            ),
+        }
+
+    def load_state(self, state):
+        self.count = state["count"]
+        self.limit = state["limit"]
+        self.type = state["type"]
+        if state.get("reset") != None:
+            self.reset = datetime.fromisoformat(state["reset"])
+        if state.get("reconciled") != None:
+            self.reconciled = datetime.fromisoformat(state["reconciled"])
+            self.suspect = False
+        self.roll()
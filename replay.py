@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+"""
+Replay recorded ESP API responses against a simulated clock.
+
+The scheduler, status engine and publisher run as in the service but
+time jumps straight to the next deadline, so a week of transitions takes
+seconds.  Every publish is written as a JSON line with its simulated time.
+"""
+import logging
+
+logger = logging.getLogger("esp_mqtt").getChild(__name__)
+import json
+import sys
+from datetime import datetime, time
+from functools import partial
+from urllib.parse import urlparse, parse_qs
+
+from config_defaults import *
+from config import *
+from pytz import timezone
+
+from clock import VirtualClock
+from esp import ESP
+
+REPLAY_API_LIMIT = 50
+
+
+class ReplayFetcher:
+    def __init__(self, scheduler, clock, areas, statuses):
+        """
+        Answers API requests from recorded responses.  Each area refresh
+        takes the next recorded area response and the last one repeats.
+        """
+        self.scheduler = scheduler
+        self.clock = clock
+        self.areas = areas
+        self.statuses = statuses
+        self.calls = {}
+        self.count = 0
+        self.day = None
+
+    def submit(self, work, callback):
+        self.scheduler.call_soon(partial(callback, work()))
+
+    def next_response(self, key, responses):
+        if not responses:
+            return None
+        i = self.calls.get(key, 0)
+        self.calls[key] = i + 1
+        self.count += 1
+        return responses[min(i, len(responses) - 1)]
+
+    def get(self, url, data={}, keys=()):
+        url = urlparse(url)
+        endpoint = url.path.rsplit("/", 1)[-1]
+        # the allowance resets at midnight
+        today = self.clock.now(timezone(TIMEZONE)).date()
+        if today != self.day:
+            self.day = today
+            self.count = 0
+        if endpoint == "api_allowance":
+            return {
+                "allowance": {
+                    "count": self.count,
+                    "limit": REPLAY_API_LIMIT,
+                    "type": "daily",
+                }
+            }
+        if endpoint == "area":
+            area_id = parse_qs(url.query)["id"][0]
+            return self.next_response(area_id, self.areas)
+        if endpoint == "status":
+            return self.next_response("status", self.statuses)
+        return None
+
+
+class PublishInfo:
+    def __init__(self, mid):
+        self.mid = mid
+        self.rc = 0
+
+
+class RecordingClient:
+    def __init__(self, clock, output):
+        """Stands in for the paho client, writing publishes to output."""
+        self.clock = clock
+        self.output = output
+        self.count = 0
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.on_publish = None
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if isinstance(payload, bytes):
+            payload = payload.decode("utf-8")
+        record = {
+            "time": self.clock.now(timezone(TIMEZONE)).isoformat(),
+            "topic": topic,
+            "payload": payload,
+        }
+        self.output.write(json.dumps(record) + "\n")
+        self.count += 1
+        if self.on_publish != None:
+            self.on_publish(self, None, self.count)
+        return PublishInfo(self.count)
+
+    def is_connected(self):
+        return True
+
+    def will_set(self, *args, **kwargs):
+        pass
+
+    def reconnect_delay_set(self, *args, **kwargs):
+        pass
+
+    def username_pw_set(self, *args, **kwargs):
+        pass
+
+    def max_inflight_messages_set(self, *args):
+        pass
+
+    def connect_async(self, *args, **kwargs):
+        pass
+
+    def loop_start(self):
+        if self.on_connect != None:
+            self.on_connect(self, None, {}, 0)
+
+    def subscribe(self, *args, **kwargs):
+        pass
+
+
+def default_start(areas):
+    """Midnight before the first recorded event, or before now."""
+    tz = timezone(TIMEZONE)
+    starts = [
+        datetime.fromisoformat(event["start"]) for r in areas for event in r["events"]
+    ]
+    if starts:
+        day = min(starts).astimezone(tz).date()
+    else:
+        day = datetime.now(tz).date()
+    return tz.localize(datetime.combine(day, time.min))
+
+
+def replay(paths, output=sys.stdout, start=None, hours=24 * 7):
+    """Replay the responses in paths for hours.  Returns the publish count."""
+    areas = []
+    statuses = []
+    for path in paths:
+        with open(path) as f:
+            r = json.load(f)
+        if "status" in r:
+            statuses.append(r)
+        else:
+            areas.append(r)
+    if start == None:
+        start = default_start(areas)
+    clock = VirtualClock(start)
+    client = RecordingClient(clock, output)
+    fetcher = partial(ReplayFetcher, clock=clock, areas=areas, statuses=statuses)
+    e = ESP(clock=clock, client=client, fetcher=fetcher, state_file=None)
+    e.start()
+    end = clock.monotonic() + hours * 3600
+    while True:
+        deadline = e.scheduler.next_deadline()
+        if deadline == None or deadline > end:
+            break
+        clock.advance_to(deadline)
+        e.scheduler.run_pending()
+    logger.info(
+        "Replayed {} hours from {}, {} publishes and {} API calls.".format(
+            hours, start.isoformat(), client.count, sum(e.fetcher.calls.values())
+        )
+    )
+    return client.count
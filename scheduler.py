@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+import logging
+
+logger = logging.getLogger("esp_mqtt").getChild(__name__)
+import heapq
+from itertools import count
+from threading import Condition
+from datetime import timezone
+from clock import Clock
+import metrics
+
+
+class Scheduler:
+    def __init__(self, clock_check=None, step_tolerance=0.05, clock=None):
+        """Deadline scheduler keyed on the monotonic clock.
+
+        Jobs are named.  Scheduling a name that is already pending replaces
+        the earlier deadline so each job is only ever queued once.
+
+        Jobs scheduled for a wall clock instant with schedule_at follow the
+        wall clock.  With clock_check set the wall clock is compared to the
+        monotonic clock at least that often while such a job is pending and
+        a step larger than step_tolerance seconds moves them.
+
+        clock supplies both times, a Clock unless given.
+        """
+        if clock == None:
+            clock = Clock()
+        self.clock = clock
+        self.heap = []
+        self.jobs = {}
+        self.counter = count()
+        self.condition = Condition()
+        self.clock_check = clock_check
+        self.step_tolerance = step_tolerance
+        self.offset = self.wall_offset()
+
+    def add(self, name, deadline, callback, when=None):
+        with self.condition:
+            old = self.jobs.get(name)
+            if old != None:
+                old[3] = None
+            entry = [deadline, next(self.counter), name, callback, when]
+            self.jobs[name] = entry
+            heapq.heappush(self.heap, entry)
+            self.condition.notify()
+
+    def schedule(self, name, delay, callback):
+        """Run callback after delay seconds, replacing any pending job of the same name."""
+        self.add(name, self.clock.monotonic() + max(delay, 0), callback)
+
+    def call_soon(self, callback):
+        """Run callback on the scheduler thread as soon as possible."""
+        with self.condition:
+            entry = [self.clock.monotonic(), next(self.counter), None, callback, None]
+            heapq.heappush(self.heap, entry)
+            self.condition.notify()
+
+    def schedule_at(self, name, when, callback):
+        """Run callback at the aware datetime when, following the wall clock."""
+        self.add(name, self.deadline_at(when), callback, when)
+
+    def deadline_at(self, when):
+        delay = (when - self.clock.now(timezone.utc)).total_seconds()
+        return self.clock.monotonic() + max(delay, 0)
+
+    def wall_offset(self):
+        """Wall clock minus monotonic clock in seconds."""
+        return self.clock.now(timezone.utc).timestamp() - self.clock.monotonic()
+
+    def check_clock(self):
+        """Move wall clock jobs if the wall clock was stepped.  Returns the step."""
+        offset = self.wall_offset()
+        step = offset - self.offset
+        if abs(step) <= self.step_tolerance:
+            return 0
+        self.offset = offset
+        logger.info("Wall clock moved {:+.3f}s, rescheduling.".format(step))
+        metrics.CLOCK_STEPS.inc()
+        with self.condition:
+            for entry in list(self.jobs.values()):
+                if entry[4] != None:
+                    self.add(entry[2], self.deadline_at(entry[4]), entry[3], entry[4])
+        return step
+
+    def wall_jobs_pending(self):
+        with self.condition:
+            return any(entry[4] != None for entry in self.jobs.values())
+
+    def cancel(self, name):
+        with self.condition:
+            entry = self.jobs.pop(name, None)
+            if entry != None:
+                entry[3] = None
+
+    def pending(self, name):
+        with self.condition:
+            return name in self.jobs
+
+    def next_deadline(self):
+        """Monotonic deadline of the earliest live job or None."""
+        with self.condition:
+            self.discard_cancelled()
+            if self.heap:
+                return self.heap[0][0]
+            return None
+
+    def discard_cancelled(self):
+        while self.heap and self.heap[0][3] == None:
+            heapq.heappop(self.heap)
+
+    def pop_due(self, now):
+        due = []
+        with self.condition:
+            self.discard_cancelled()
+            while self.heap and self.heap[0][0] <= now:
+                entry = heapq.heappop(self.heap)
+                if entry[3] != None:
+                    if entry[2] != None:
+                        del self.jobs[entry[2]]
+                    due.append(entry)
+                self.discard_cancelled()
+        return due
+
+    def run_pending(self):
+        """Run every job that is due.  Returns the number of jobs run."""
+        if self.clock_check != None:
+            self.check_clock()
+        due = self.pop_due(self.clock.monotonic())
+        run = 0
+        for deadline, _, name, callback, when in due:
+            lag = self.clock.monotonic() - deadline
+            if when != None:
+                lag = (self.clock.now(timezone.utc) - when).total_seconds()
+                if lag < 0 and not self.pending(name):
+                    # the wall clock runs slow against the monotonic clock
+                    self.schedule_at(name, when, callback)
+                    continue
+            if name != None:
+                logger.debug("Running {} ({:.3f}s late).".format(name, lag))
+                # per area jobs share one label
+                metrics.SCHEDULER_LAG_SECONDS.observe(lag, name.split("/")[0])
+            try:
+                callback()
+            except Exception as e:
+                logger.exception("Scheduled job {} failed: {}".format(name, e))
+            run += 1
+        return run
+
+    def wait(self):
+        """Sleep until the next deadline or until a new job is scheduled."""
+        with self.condition:
+            self.discard_cancelled()
+            if self.heap:
+                timeout = self.heap[0][0] - self.clock.monotonic()
+                if self.clock_check != None and self.wall_jobs_pending():
+                    # wake up now and then to notice a wall clock step
+                    # forward, run_pending re-arms jobs a step back fired
+                    # early
+                    timeout = min(timeout, self.clock_check)
+                if timeout > 0:
+                    self.condition.wait(timeout)
+            else:
+                self.condition.wait()
+
+    def run_forever(self):
+        while True:
+            self.run_pending()
+            self.wait()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+import logging
+
+logger = logging.getLogger("esp_mqtt").getChild(__name__)
+import hashlib
+import json
+from bisect import bisect
+
+from config_defaults import *
+from config import *
+from pytz import timezone
+
+
+def ring_hash(key):
+    return int.from_bytes(hashlib.sha1(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    def __init__(self, workers, replicas=ESP_SHARD_REPLICAS):
+        """
+        Consistent hash ring, each worker at replicas points.  Adding or
+        removing a worker only moves the keys next to its points.
+        """
+        self.ring = sorted(
+            (ring_hash("{}#{}".format(w, i)), w)
+            for w in workers
+            for i in range(replicas)
+        )
+        self.hashes = [h for h, _ in self.ring]
+
+    def owner(self, key):
+        if not self.ring:
+            return None
+        i = bisect(self.hashes, ring_hash(key)) % len(self.ring)
+        return self.ring[i][1]
+
+
+class Shard:
+    def __init__(self, esp, worker):
+        """
+        Split the configured areas between the workers sharing one
+        coordination broker (the first broker).
+
+        Under HOMIE_BASE_TOPIC/$shard each worker keeps a retained $state,
+        ready while connected and lost through its will, and the serving
+        worker holds a retained lease per area that it renews.  An area
+        belongs to the worker the hash ring of ready workers picks, which
+        only takes it over once the previous lease is released, expired or
+        held by a lost worker, so no area is fetched twice.
+        """
+        self.esp = esp
+        self.worker = worker
+        self.prefix = "{}/$shard".format(HOMIE_BASE_TOPIC)
+        self.state_topic = "{}/{}/$state".format(self.prefix, worker)
+        # $state by worker and (worker, expiry timestamp) by area_id
+        self.workers = {}
+        self.leases = {}
+        self.broker = None
+        self.settled = False
+
+    def attach(self, broker, routes):
+        self.broker = broker
+        routes.add(self.prefix + "/+/$state", self.message)
+        routes.add(self.prefix + "/leases/+", self.message)
+
+    def lease_topic(self, area):
+        return "{}/leases/{}".format(self.prefix, area.area_id)
+
+    def publish(self, topic, message):
+        self.broker.publisher.publish(topic, message, qos=1, retain=True)
+
+    def message(self, topic, payload):
+        payload = payload.decode("utf-8")
+        levels = topic[len(self.prefix) + 1 :].split("/")
+        if levels[0] == "leases":
+            before = self.leases.pop(levels[1], (None,))[0]
+            if payload:
+                lease = json.loads(payload)
+                self.leases[levels[1]] = (lease["worker"], lease["expires"])
+            # renewals by the same worker change nothing
+            changed = self.leases.get(levels[1], (None,))[0] != before
+        else:
+            changed = self.workers.get(levels[0]) != payload
+            self.workers[levels[0]] = payload
+        if changed and self.settled:
+            self.esp.scheduler.schedule("shard_rebalance", 0, self.rebalance)
+
+    def connected(self):
+        """Announce the worker and rebalance once the retained topics are in."""
+        self.broker.client.subscribe(
+            [(self.prefix + "/+/$state", 1), (self.prefix + "/leases/+", 1)]
+        )
+        self.publish(self.state_topic, "ready")
+        self.esp.scheduler.schedule(
+            "shard_rebalance", ESP_SHARD_SETTLE_SECONDS, self.rebalance
+        )
+
+    def disconnected(self):
+        # the others take over as soon as they see our will
+        logger.warning("Lost the coordination broker, serving no areas.")
+        self.settled = False
+        self.esp.scheduler.cancel("shard_rebalance")
+        self.esp.scheduler.cancel("shard_renew")
+        self.esp.set_areas([])
+
+    def live_workers(self):
+        live = set(w for w, state in self.workers.items() if state == "ready")
+        live.add(self.worker)
+        return live
+
+    def rebalance(self):
+        self.settled = True
+        live = self.live_workers()
+        ring = HashRing(live)
+        now = self.esp.clock.now(timezone(TIMEZONE)).timestamp()
+        areas = []
+        retry = None
+        for area in self.esp.all_areas:
+            if ring.owner(area.area_id) != self.worker:
+                continue
+            holder, expires = self.leases.get(area.area_id, (None, 0))
+            if holder in (None, self.worker) or holder not in live or expires <= now:
+                areas.append(area)
+            elif retry == None or expires < retry:
+                # still leased to another worker, look again when it expires
+                retry = expires
+        for area in self.esp.areas:
+            if area not in areas and self.leases.get(area.area_id, (None,))[0] in (
+                None,
+                self.worker,
+            ):
+                self.publish(self.lease_topic(area), "")
+        if areas != self.esp.areas:
+            logger.info(
+                "Worker {} of {} serves {} of {} areas.".format(
+                    self.worker, len(live), len(areas), len(self.esp.all_areas)
+                )
+            )
+        acquired = [a for a in areas if a not in self.esp.areas]
+        self.esp.set_areas(areas)
+        self.publish_leases(acquired)
+        if not self.esp.scheduler.pending("shard_renew"):
+            self.renew()
+        if retry != None:
+            self.esp.scheduler.schedule("shard_rebalance", retry - now, self.rebalance)
+
+    def renew(self):
+        self.esp.scheduler.schedule(
+            "shard_renew", ESP_SHARD_LEASE_SECONDS / 3, self.renew
+        )
+        self.publish_leases(self.esp.areas)
+
+    def publish_leases(self, areas):
+        expires = (
+            self.esp.clock.now(timezone(TIMEZONE)).timestamp() + ESP_SHARD_LEASE_SECONDS
+        )
+        lease = json.dumps({"worker": self.worker, "expires": expires})
+        for area in areas:
+            self.publish(self.lease_topic(area), lease)
+
+    def share(self, remaining):
+        """This worker's part of the remaining API calls, by areas served."""
+        return remaining * len(self.esp.areas) // len(self.esp.all_areas)
@@ -0,0 +1,51 @@
+import mmap
+import os
+import sys
+import tempfile
+import types
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+# the modules read settings from the user's config.py
+sys.modules.setdefault("config", types.ModuleType("config"))
+
+from archive import Archive, History
+from timeline import Event
+
+# 2025-10-01 00:00 SAST
+DAY = 1759269600.0
+
+
+class ArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def history(self):
+        history = History(self.directory)
+        self.addCleanup(history.close)
+        return history
+
+    def test_restart_archives_no_change(self):
+        events = [Event(DAY + 3600, DAY + 7200, "Stage 2")]
+        Archive(self.directory).schedule("x", DAY, events)
+        # a restart starts without the last schedule written
+        Archive(self.directory).schedule("x", DAY + 600, events)
+        changed = [Event(DAY + 1800, DAY + 7200, "Stage 2")]
+        Archive(self.directory).schedule("x", DAY + 1200, changed)
+        self.assertEqual(self.history().schedule_changes(2), {("x", "2025-10"): [1, 1]})
+
+    def test_reads_from_memory_maps(self):
+        archive = Archive(self.directory, segment_bytes=64)
+        for hour in range(4):
+            archive.transition("x", DAY + hour * 7200, True, "Stage 2")
+            archive.transition("x", DAY + hour * 7200 + 3600, False, "")
+        history = self.history()
+        self.assertGreater(len(history.segments), 1)
+        for m, _ in history.segments:
+            self.assertIsInstance(m, mmap.mmap)
+        self.assertEqual(len(history), 8)
+        self.assertEqual(history.outage_hours("day"), {("x", "2025-10-01"): 4.0})
+
+
+if __name__ == "__main__":
+    unittest.main()
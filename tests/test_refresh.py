@@ -0,0 +1,109 @@
+import io
+import os
+import sys
+import types
+import unittest
+from datetime import datetime, timedelta
+from functools import partial
+from unittest import mock
+from urllib.parse import urlparse
+
+root = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, "benchmarks"))
+# the modules read settings from the user's config.py
+sys.modules.setdefault("config", types.ModuleType("config"))
+
+from pytz import timezone
+
+import esp
+from clock import VirtualClock
+from fake_api import FakeESPAPI
+from replay import RecordingClient
+
+TZ = timezone("Africa/Johannesburg")
+
+
+class FakeFetcher:
+    def __init__(self, scheduler, clock, api, resets=True):
+        """
+        Answers API requests from api on the virtual clock, in line.  The
+        allowance count starts again at midnight if resets.
+        """
+        self.scheduler = scheduler
+        self.clock = clock
+        self.api = api
+        self.resets = resets
+        # (time, endpoint) of each request
+        self.calls = []
+
+    def submit(self, work, callback):
+        self.scheduler.call_soon(partial(callback, work()))
+
+    def get(self, url, data={}, keys=()):
+        endpoint = urlparse(url).path.rsplit("/", 1)[-1]
+        now = self.clock.now(TZ)
+        self.calls.append((now, endpoint))
+        if endpoint == "api_allowance":
+            count = len(
+                [
+                    t
+                    for t, e in self.calls
+                    if e in ("area", "status")
+                    and (t.date() == now.date() or not self.resets)
+                ]
+            )
+            return {
+                "allowance": {"count": count, "limit": self.api.limit, "type": "daily"}
+            }
+        if endpoint == "area":
+            return self.api.area(esp.ESP_AREA_ID, {})
+        return self.api.status()
+
+
+class RefreshTest(unittest.TestCase):
+    def run_days(self, days, resets=True):
+        start = TZ.localize(datetime(2026, 10, 14))
+        clock = VirtualClock(start)
+        api = FakeESPAPI(stage=2, now=partial(clock.now, TZ))
+        self.addCleanup(api.server.server_close)
+        e = esp.ESP(
+            clock=clock,
+            client=RecordingClient(clock, io.StringIO()),
+            fetcher=partial(FakeFetcher, clock=clock, api=api, resets=resets),
+            state_file=None,
+        )
+        e.start()
+        end = days * 24 * 3600
+        while e.scheduler.next_deadline() <= end:
+            clock.advance_to(e.scheduler.next_deadline())
+            e.scheduler.run_pending()
+        return e, start
+
+    @mock.patch.object(esp, "ESP_LOCAL_SCHEDULE", True)
+    def test_fetches_area_when_timetable_expires(self):
+        e, start = self.run_days(10)
+        areas = [t for t, endpoint in e.fetcher.calls if endpoint == "area"]
+        # the first timetable covers 7 days
+        expires = start + timedelta(days=6)
+        self.assertEqual(areas[0].date(), start.date())
+        self.assertTrue(any(t >= expires for t in areas))
+        # and the events derived from the new timetable carry on
+        self.assertTrue(e.areas[0].timeline.upcoming(e.clock.now(TZ).timestamp()))
+
+    def test_waits_for_the_reset_when_out_of_calls(self):
+        e, start = self.run_days(4, resets=False)
+        days = {}
+        for t, endpoint in e.fetcher.calls:
+            days[t.date(), endpoint] = days.get((t.date(), endpoint), 0) + 1
+        for d in range(1, 4):
+            day = (start + timedelta(days=d)).date()
+            # a look at the allowance after the reset and no more
+            self.assertLessEqual(days.get((day, "api_allowance"), 0), 2)
+            self.assertNotIn((day, "area"), days)
+        # running out of calls is no failed fetch
+        self.assertEqual(e.failed_update, None)
+
+
+if __name__ == "__main__":
+    unittest.main()
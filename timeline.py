@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+import logging
+
+logger = logging.getLogger("esp_mqtt").getChild(__name__)
+import sys
+from bisect import bisect_right
+from collections import namedtuple
+from datetime import datetime
+from functools import lru_cache
+
+from config_defaults import *
+from config import *
+from pytz import timezone
+
+# all times in the timeline are epoch seconds
+WARNING_15MIN = 15 * 60
+WARNING_5MIN = 5 * 60
+FAR_AWAY = FAR_AWAY_DATE.timestamp()
+TZ = timezone(TIMEZONE)
+
+
+@lru_cache(maxsize=4096)
+def to_datetime(seconds):
+    """Aware datetime for epoch seconds, None stays None."""
+    if seconds == None:
+        return None
+    if seconds == FAR_AWAY:
+        return FAR_AWAY_DATE
+    return datetime.fromtimestamp(seconds, TZ)
+
+
+class Event:
+    __slots__ = ("start", "end", "note")
+
+    def __init__(self, start, end, note):
+        """An outage from start to end in epoch seconds, note is interned."""
+        self.start = start
+        self.end = end
+        self.note = sys.intern(note)
+
+    @classmethod
+    def parse(cls, event):
+        """Event from an API event with ISO start and end."""
+        return cls(
+            datetime.fromisoformat(event["start"]).timestamp(),
+            datetime.fromisoformat(event["end"]).timestamp(),
+            event["note"],
+        )
+
+    def to_dict(self):
+        return {
+            "start": to_datetime(self.start).isoformat(),
+            "end": to_datetime(self.end).isoformat(),
+            "note": self.note,
+        }
+
+
+Status = namedtuple(
+    "Status",
+    [
+        "loadshedding",
+        "warning_15min",
+        "warning_5min",
+        "next_start",
+        "next_end",
+        "end",
+        "note",
+        "next_transition",
+    ],
+)
+
+
+class Timeline:
+    def __init__(self, events):
+        """Compile Event records into sorted outage intervals.
+
+        Overlapping and back to back events are merged into one interval so
+        only real transitions are reported.  Built once per fetch, queried
+        with a bisect on every status update.
+        """
+        self.events = sorted(events, key=lambda e: e.start)
+        self.event_starts = [e.start for e in self.events]
+        self.starts = []
+        self.ends = []
+        for event in self.events:
+            if self.ends and event.start <= self.ends[-1]:
+                if event.end > self.ends[-1]:
+                    self.ends[-1] = event.end
+            else:
+                self.starts.append(event.start)
+                self.ends.append(event.end)
+
+    def note(self, now, interval_start):
+        """Note of the latest started event covering now."""
+        i = bisect_right(self.event_starts, now) - 1
+        while i >= 0 and self.events[i].start >= interval_start:
+            if self.events[i].end > now:
+                return self.events[i].note
+            i -= 1
+        return None
+
+    def upcoming(self, now):
+        """Events that have not ended by now (epoch seconds)."""
+        return [e for e in self.events if e.end > now]
+
+    def status(self, now):
+        """
+        Status at now and the instant it next changes, all in epoch
+        seconds.  Use to_datetime to publish them.
+        """
+        i = bisect_right(self.starts, now) - 1
+        if i >= 0 and now < self.ends[i]:
+            loadshedding = True
+            end = self.ends[i]
+            note = self.note(now, self.starts[i])
+        else:
+            loadshedding = False
+            end = FAR_AWAY
+            note = "Not loadshedding"
+        if i + 1 < len(self.starts):
+            next_start = self.starts[i + 1]
+            next_end = self.ends[i + 1]
+        else:
+            next_start = FAR_AWAY
+            next_end = FAR_AWAY
+        transitions = [
+            next_start - WARNING_15MIN,
+            next_start - WARNING_5MIN,
+            next_start,
+        ]
+        if loadshedding:
+            transitions.append(end)
+        next_transition = min(t for t in transitions if t > now)
+        return Status(
+            loadshedding=loadshedding,
+            warning_15min=next_start - now <= WARNING_15MIN,
+            warning_5min=next_start - now <= WARNING_5MIN,
+            next_start=next_start,
+            next_end=next_end,
+            end=end,
+            note=note,
+            next_transition=next_transition,
+        )
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+import logging
+
+logger = logging.getLogger("esp_mqtt").getChild(__name__)
+from array import array
+from datetime import datetime, timedelta, time, date
+
+from config_defaults import *
+from config import *
+from pytz import timezone
+from timeline import Event
+
+# stage periods start from here when the status has no earlier change
+LONG_AGO_DATE = datetime(1900, 1, 1, 0, 0, 0, 0, timezone(TIMEZONE))
+
+
+def region_for_area(area_id):
+    """Key of the status endpoint region whose stage applies to the area."""
+    if area_id.startswith("capetown-"):
+        return "capetown"
+    return "eskom"
+
+
+def parse_stages(status, region):
+    """
+    Turn one region of a status response into a list of
+    (stage, start, end) periods covering all time.
+    """
+    region = status["status"][region]
+    changes = [(int(region["stage"]), LONG_AGO_DATE)]
+    for next_stage in region.get("next_stages", []):
+        start = datetime.fromisoformat(next_stage["stage_start_timestamp"])
+        changes.append((int(next_stage["stage"]), start))
+    changes.sort(key=lambda c: c[1])
+    periods = []
+    for i, (stage, start) in enumerate(changes):
+        if i + 1 < len(changes):
+            end = changes[i + 1][1]
+        else:
+            end = FAR_AWAY_DATE
+        periods.append((stage, start, end))
+    return periods
+
+
+class Timetable:
+    def __init__(self, schedule):
+        """
+        Per stage time slots for each day of an area `schedule` block, each
+        stage a flat array of start and end epoch seconds.
+        """
+        tz = timezone(TIMEZONE)
+        self.days = []
+        for day in schedule["days"]:
+            d = date.fromisoformat(day["date"])
+            stages = []
+            for slots in day["stages"]:
+                intervals = array("d")
+                for slot in slots:
+                    start, end = slot.split("-")
+                    start = tz.localize(datetime.combine(d, time.fromisoformat(start)))
+                    end = tz.localize(datetime.combine(d, time.fromisoformat(end)))
+                    if end <= start:
+                        # slot runs past midnight
+                        end = tz.normalize(end + timedelta(days=1))
+                    intervals.append(start.timestamp())
+                    intervals.append(end.timestamp())
+                stages.append(intervals)
+            self.days.append((d, stages))
+
+    def expires(self):
+        """Start of the last day covered, when a fresh `area` fetch is due."""
+        if not self.days:
+            return LONG_AGO_DATE
+        return timezone(TIMEZONE).localize(datetime.combine(self.days[-1][0], time.min))
+
+    def events(self, periods):
+        """Outage events for the stage periods."""
+        events = []
+        for stage, period_start, period_end in periods:
+            if stage < 1:
+                continue
+            period_start = period_start.timestamp()
+            period_end = period_end.timestamp()
+            note = "Stage {}".format(stage)
+            for d, stages in self.days:
+                if stage > len(stages):
+                    continue
+                intervals = stages[stage - 1]
+                for i in range(0, len(intervals), 2):
+                    start = max(intervals[i], period_start)
+                    end = min(intervals[i + 1], period_end)
+                    if start < end:
+                        events.append(Event(start, end, note))
+        events.sort(key=lambda e: e.start)
+        return events